@@ -1,11 +1,20 @@
 import gradio as gr
+import os
 import json
+import asyncio
 import logging
-from config import METADATA_PATH, LICENSE_LLAMA, LICENSE_MELO, LICENSE_MUSIC
-from story_gen import generate_story
-from tts_gen import generate_narration
-from music_gen import generate_music
-from combine_audio import combine_audio
+import metrics
+from config import (
+    METADATA_PATH, LICENSE_LLAMA, LICENSE_MELO, LICENSE_MUSIC, MUSIC_MODE, MAX_CONCURRENT_SESSIONS, MUSIC_DIR,
+)
+from story_gen import generate_story_async
+from tts_gen import generate_narration_async
+from workers import run_cpu, cpu_executor
+from deadline import Deadline
+from profiling import start_request_profile, stage, new_request_id
+from checkpoints import request_key, load_checkpoint, save_checkpoint, clear_checkpoint
+from music_gen import generate_music_async, generate_underlay_music, warm_conditioning_cache, EXPECTED_SR as MUSIC_SR
+from combine_audio import combine_audio, combine_audio_underlay, get_narration_durations
 
 # --------------------------------------------------------
 # LOGGING CONFIGURATION
@@ -56,19 +65,116 @@ def get_characters(setting_key):
         return {f"{char} {characters[char]['icon']}": char for char in settings[setting_key]["compatible_characters"]}
     return {}
 
+def warm_music_conditioning():
+    """Precomputes the MusicGen conditioning of every setting's music prompts (see music_gen.py)."""
+    try:
+        warm_conditioning_cache({key: setting["description"] for key, setting in settings.items()})
+    except Exception as e:
+        # Prompts are then encoded on first use instead
+        logging.error(f"Failed to warm the music conditioning cache: {e}")
+
+# --------------------------------------------------------
+# SESSION CANCELLATION
+# --------------------------------------------------------
+
+# Pipeline run in progress per browser session (Gradio session hash -> asyncio task)
+active_pipelines = {}
+
+# How long a new run waits for the cancelled previous run of its session to clean up
+CANCEL_WAIT_SECONDS = 10
+
+async def cancel_session_pipeline(session_hash, reason):
+    """
+    Cancels the pipeline run still in progress for a browser session, if any.
+
+    Cancellation reaches every stage: the `ollama` process is killed, pending TTS
+    requests are aborted, MusicGen stops at its next decoding step (once no other
+    session waits for the same music) and partial files are removed.
+
+    Parameters:
+        session_hash (str): Gradio session of the run.
+        reason (str): "superseded" (Generate clicked again) or "disconnected" (tab closed).
+    """
+    task = active_pipelines.get(session_hash)
+    if task is None or task.done() or task is asyncio.current_task():
+        return
+
+    logging.info(f"Cancelling pipeline of session {session_hash} ({reason}).")
+    metrics.increment(f"pipeline.cancelled_{reason}")
+    task.cancel()
+    await asyncio.wait({task}, timeout=CANCEL_WAIT_SECONDS)
+
+async def on_session_closed(request: gr.Request):
+    """Stops the session's pipeline run when its browser tab is closed or reloaded."""
+    await cancel_session_pipeline(request.session_hash, "disconnected")
+
+def remove_partial_artifacts(created):
+    """
+    Deletes the files an abandoned run created itself.
+
+    Files resumed from a checkpoint are left alone (they belong to an earlier run), and
+    music clips are kept: identical music requests share them across sessions.
+
+    Parameters:
+        created (dict): Stage name -> paths of the files this run generated in that stage.
+
+    Returns:
+        list: The stages whose files were removed (their checkpoints are now stale).
+    """
+    music_dir = os.path.abspath(MUSIC_DIR)
+    removed = 0
+    removed_stages = []
+    for stage_name, paths in created.items():
+        stage_paths = [path for path in paths
+                       if not os.path.abspath(path).startswith(music_dir) and os.path.exists(path)]
+        for path in stage_paths:
+            os.remove(path)
+        if stage_paths:
+            removed_stages.append(stage_name)
+        removed += len(stage_paths)
+    logging.info(f"Removed {removed} partial file(s) of the cancelled request.")
+    metrics.increment("pipeline.partial_files_removed", removed)
+    return removed_stages
+
+def discard_partial_run(key, created):
+    """Removes the files a cancelled run created and forgets the checkpoints of those stages."""
+    clear_checkpoint(key, remove_partial_artifacts(created))
+
 # --------------------------------------------------------
 # FULL PIPELINE: STORY, NARRATION, MUSIC, AUDIO COMBINATION
 # --------------------------------------------------------
 
-def full_pipeline(setting_key, selected_characters, theme_key):
+def check_deadline(deadline):
+    """Stops the pipeline with a user-facing error once the request deadline has passed."""
+    if deadline.expired():
+        raise gr.Error("⏱️ Story generation took too long. Please try again.")
+
+def read_story(path):
+    """Reads a saved story file (used when resuming from a checkpoint)."""
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+async def full_pipeline(setting_key, selected_characters, theme_key, request: gr.Request = None):
     """
     Runs the full pipeline to generate a narrated children's story with background music.
+
+    I/O-bound stages (LLM, TTS) are awaited on the event loop; CPU-bound stages
+    (MusicGen, mixing) run on the shared CPU executor, so a waiting session holds no thread.
+    Every stage shares one Deadline (REQUEST_DEADLINE_SECONDS), so a hung backend cannot
+    pin the request indefinitely. Completed stages are checkpointed, so retrying a
+    failed or interrupted request with the same inputs from the same session resumes
+    after the last one.
+
+    A run is cancelled when its session clicks Generate again, presses Stop or closes
+    the tab; the files it produced so far are then removed.
+
     Steps:
     1. Converts UI selections back to internal metadata keys.
     2. Validates user input.
     3. Generates a story based on the selected setting, characters, and theme.
     4. Creates a narrated audio version of the story.
-    5. Generates background music.
+    5. Generates background music (short clips, or long-form music under each
+       narration section when MUSIC_MODE is "underlay").
     6. Merges narration and music into a final audio output.
     7. Returns the story text and the audio file path.
     """
@@ -89,32 +195,141 @@ def full_pipeline(setting_key, selected_characters, theme_key):
     if not theme_key:
         raise gr.Error("⚠️ Please select a theme.")
 
+    # A new run replaces the session's previous one
+    session_hash = request.session_hash if request is not None else None
+    if session_hash is not None:
+        await cancel_session_pipeline(session_hash, "superseded")
+        active_pipelines[session_hash] = asyncio.current_task()
+
     logging.info(f"Generating story for Setting: {setting_key}, Characters: {selected_characters}, Theme: {theme_key}")
+    deadline = Deadline()
+    artifacts = []
+    created = {}
+    # Names every file this run writes, so concurrent sessions never overwrite each other
+    request_id = new_request_id()
+    # Checkpoint of this run; fixed for the whole run and private to the session
+    key = request_key(session_hash, setting_key, selected_characters, theme_key)
+
+    # Opt-in profiling (PROFILE_SAMPLE_RATE); stages are always timed in metrics
+    profile = start_request_profile(request_id=request_id)
+    try:
+        return await run_pipeline_stages(setting_key, selected_characters, theme_key, deadline, artifacts, created,
+                                         request_id, key)
+    except asyncio.CancelledError:
+        logging.info("Pipeline cancelled.")
+        metrics.increment("pipeline.requests_cancelled")
+        # Off the event loop: file removal and SQLite (busy timeout) would block other sessions
+        await run_cpu(discard_partial_run, key, created)
+        raise
+    finally:
+        if session_hash is not None and active_pipelines.get(session_hash) is asyncio.current_task():
+            del active_pipelines[session_hash]
+        if profile is not None:
+            profile.artifacts = artifacts
+            profile.save()
+
+async def run_pipeline_stages(setting_key, selected_characters, theme_key, deadline, artifacts, created, request_id, key):
+    """
+    Runs the story, narration, music and mixing stages of `full_pipeline`.
+
+    Stages recorded in the request's checkpoint (see checkpoints.py) are skipped and
+    their saved outputs reused; each newly completed stage is checkpointed, and the
+    checkpoint is cleared once the final audio exists.
+
+    Parameters:
+        setting_key (str): The selected story setting.
+        selected_characters (list): List of chosen characters.
+        theme_key (str): The selected theme.
+        deadline (Deadline): Request budget shared by all stages.
+        artifacts (list): Receives the paths of every file used for this request.
+        created (dict): Receives, per stage, the paths of the files generated by this run
+            (as opposed to resumed from a checkpoint).
+        request_id (str): Unique id of this run, used in every output file name.
+        key (str or None): Checkpoint key from `request_key` (None disables checkpoints).
+
+    Returns:
+        tuple: The story text and the final audio file path.
+    """
+
+    completed = await run_cpu(load_checkpoint, key)
+    if "story" not in completed:
+        completed.pop("narration", None)  # A narration is only valid with the story it was made from
+    if completed:
+        logging.info(f"Resuming request from checkpoint, skipping: {', '.join(completed)}")
+        metrics.increment("checkpoint.stages_resumed", len(completed))
 
     # ---- STORY GENERATION ----
-    story, story_paths = generate_story(setting_key, selected_characters, theme_key)
-    if not story:
-        raise gr.Error("❌ Story generation failed.")
+    if "story" in completed:
+        story_paths = completed["story"]
+        story = await run_cpu(read_story, story_paths["full_story"])
+    else:
+        with stage("story"):
+            story, story_paths = await generate_story_async(setting_key, selected_characters, theme_key,
+                                                            deadline=deadline, request_id=request_id)
+        if not story:
+            raise gr.Error("❌ Story generation failed.")
+        created["story"] = list(story_paths.values())
+        await run_cpu(save_checkpoint, key, "story", story_paths)
+    artifacts.extend(story_paths.values())
+    check_deadline(deadline)
 
     # ---- NARRATION GENERATION ----
-    narration_paths = generate_narration([
-        story_paths["beginning"], 
-        story_paths["middle"], 
-        story_paths["ending"]
-    ])
-    if not narration_paths:
-        raise gr.Error("❌ Narration generation failed.")
+    if "narration" in completed:
+        narration_paths = completed["narration"]
+    else:
+        with stage("narration"):
+            narration_paths = await generate_narration_async([
+                story_paths["beginning"], 
+                story_paths["middle"], 
+                story_paths["ending"]
+            ], deadline=deadline, request_id=request_id)
+        if not narration_paths:
+            raise gr.Error("❌ Narration generation failed.")
+        created["narration"] = narration_paths
+        if len(narration_paths) == 3:  # A partial narration cannot be mixed, so it is not worth resuming
+            await run_cpu(save_checkpoint, key, "narration", narration_paths)
+    artifacts.extend(narration_paths)
+    check_deadline(deadline)
 
-    # ---- MUSIC GENERATION ----
     setting_description = settings[setting_key]["description"]
-    music_paths = generate_music(setting_key, setting_description)
-    if not music_paths:
-        raise gr.Error("❌ Music generation failed.")
+
+    if MUSIC_MODE == "underlay":
+        # ---- MUSIC UNDERLAY (generated window by window while mixing) ----
+        # Music is laid under each section, so all three narration parts are needed
+        if len(narration_paths) != 3:
+            raise gr.Error("❌ Narration generation failed for part of the story.")
+        with stage("combine"):
+            durations = await run_cpu(get_narration_durations, narration_paths)
+            music_streams = generate_underlay_music(setting_key, setting_description, durations, deadline)
+            full_audio_path = await run_cpu(combine_audio_underlay, narration_paths, music_streams, MUSIC_SR, request_id)
+        if not full_audio_path:
+            raise gr.Error("❌ Failed to merge final audio.")
+        artifacts.append(full_audio_path)
+        await run_cpu(clear_checkpoint, key)
+
+        return story, full_audio_path
+
+    # ---- MUSIC GENERATION ----
+    if "music" in completed:
+        music_paths = completed["music"]
+    else:
+        with stage("music"):
+            music_paths = await generate_music_async(setting_key, setting_description, deadline, request_id)
+        if not music_paths:
+            raise gr.Error("❌ Music generation failed.")
+        created["music"] = [path for path in music_paths.values() if path]
+        if all(music_paths.values()):  # Clips that failed or were skipped would fail every retry
+            await run_cpu(save_checkpoint, key, "music", music_paths)
+    artifacts.extend(path for path in music_paths.values() if path)
+    check_deadline(deadline)
 
     # ---- COMBINE AUDIO (Narration + Music) ----
-    full_audio_path = combine_audio(narration_paths, music_paths)
+    with stage("combine"):
+        full_audio_path = await run_cpu(combine_audio, narration_paths, music_paths, request_id)
     if not full_audio_path:
         raise gr.Error("❌ Failed to merge final audio.")
+    artifacts.append(full_audio_path)
+    await run_cpu(clear_checkpoint, key)
 
     return story, full_audio_path
 
@@ -133,8 +348,9 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     character_dropdown = gr.Dropdown(choices=[], multiselect=True, max_choices=3, label="Select up to 3 Characters")
     theme_dropdown = gr.Radio(choices=list(formatted_themes.keys()), label="Choose a Theme")
 
-    # Generate Button
+    # Generate and Stop Buttons
     generate_button = gr.Button("Create your custom story!")
+    stop_button = gr.Button("Stop", variant="stop")
 
     # Output fields
     final_audio_output = gr.Audio(label="Complete Story Narration with Music", type="filepath")
@@ -159,12 +375,16 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     # EXECUTE FULL PIPELINE ON BUTTON CLICK
     # --------------------------------------------------------
 
-    generate_button.click(
+    generate_event = generate_button.click(
         fn=full_pipeline, 
         inputs=[setting_dropdown, character_dropdown, theme_dropdown],
         outputs=[story_output, final_audio_output]
     )
 
+    # Stop cancels the running pipeline; closing the tab does the same
+    stop_button.click(fn=None, cancels=[generate_event])
+    demo.unload(on_session_closed)
+
     # --------------------------------------------------------
     # CREDITS & LICENSE INFORMATION
     # --------------------------------------------------------
@@ -181,5 +401,9 @@ with gr.Blocks(theme=gr.themes.Soft()) as demo:
     gr.Markdown("### **Facebook MusicGen** (Meta AI)")
     gr.File(value=LICENSE_MUSIC, label="Download Facebook MusicGen License")
 
-# Launch Gradio app
+# Encode every music prompt up front, in the background so the UI starts right away
+cpu_executor.submit(warm_music_conditioning)
+
+# Launch Gradio app; the async pipeline lets many sessions share one process
+demo.queue(default_concurrency_limit=MAX_CONCURRENT_SESSIONS)
 demo.launch(share=False, inbrowser=True)
\ No newline at end of file
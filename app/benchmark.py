@@ -0,0 +1,277 @@
+import argparse
+import glob
+import json
+import os
+import time
+import logging
+import textstat
+import metrics
+import readability
+from story_gen import generate_story, load_metadata
+from config import METADATA_PATH, STORIES_DIR
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# STORY GENERATION BENCHMARK
+# --------------------------------------------------------
+
+def default_story_inputs():
+    """Picks the first setting, its first compatible character and the first theme from the metadata."""
+    metadata = load_metadata(METADATA_PATH)
+    setting_key = next(iter(metadata["settings"]))
+    character = metadata["settings"][setting_key]["compatible_characters"][0]
+    theme_key = next(iter(metadata["themes"]))
+    return setting_key, [character], theme_key
+
+def run_story_benchmark(runs, **generate_kwargs):
+    """
+    Generates `runs` stories with the given `generate_story` keyword arguments.
+
+    Returns:
+        dict: Success rate, validation pass rate, latency percentiles and LLM usage per story.
+    """
+    setting_key, selected_characters, theme_key = default_story_inputs()
+    metrics.reset()
+    successes = 0
+
+    for run in range(runs):
+        logging.info(f"[benchmark] {generate_kwargs} run {run + 1}/{runs}")
+        story, _ = generate_story(setting_key, selected_characters, theme_key, **generate_kwargs)
+        successes += story is not None
+
+    snap = metrics.snapshot()
+    counters = snap["counters"]
+    llm = snap["timings"].get("story.llm_call_seconds", {})
+    validated = counters.get("story.candidates_validated", 0)
+
+    return {
+        "success_rate": successes / runs,
+        "validation_pass_rate": counters.get("story.candidates_passed", 0) / validated if validated else None,
+        "latency_p50": metrics.percentile("story.latency_seconds", 50),
+        "latency_p95": metrics.percentile("story.latency_seconds", 95),
+        "llm_calls_per_story": counters.get("story.llm_calls", 0) / runs,
+        "llm_calls_cancelled_per_story": counters.get("story.llm_calls_cancelled", 0) / runs,
+        "llm_seconds_per_story": llm.get("count", 0) * llm.get("mean", 0) / runs,
+        "single_call_parse_failures": counters.get("story.single_call_parse_failures", 0),
+    }
+
+def compare_to_baseline(results, baseline_key):
+    """Adds p95 latency improvement and extra LLM compute relative to `results[baseline_key]`."""
+    baseline = results.get(baseline_key)
+    if not baseline:
+        return results
+
+    for result in results.values():
+        if baseline["latency_p95"] and result["latency_p95"]:
+            result["p95_improvement"] = 1 - result["latency_p95"] / baseline["latency_p95"]
+        if baseline["llm_seconds_per_story"]:
+            result["extra_llm_compute"] = result["llm_seconds_per_story"] / baseline["llm_seconds_per_story"] - 1
+    return results
+
+def benchmark_story(runs, candidate_counts):
+    """
+    Compares serial and speculative parallel story generation.
+
+    - Latency: p50 / p95 of the end-to-end `generate_story` call.
+    - LLM compute: completed and cancelled model calls, and total model seconds per story.
+      The extra compute of speculative generation is the difference against K = 1.
+
+    Parameters:
+        runs (int): Number of stories generated per configuration.
+        candidate_counts (list): Values of `max_parallel_candidates` to compare.
+
+    Returns:
+        dict: Results keyed by candidate count.
+    """
+    results = {
+        candidates: run_story_benchmark(runs, max_parallel_candidates=candidates)
+        for candidates in candidate_counts
+    }
+    return compare_to_baseline(results, 1)
+
+def benchmark_story_modes(runs, modes):
+    """
+    Compares the three-call ("sections") and single-call story generation modes.
+
+    Parameters:
+        runs (int): Number of stories generated per mode.
+        modes (list): Generation modes to compare.
+
+    Returns:
+        dict: Results keyed by mode, including latency and validation pass rate.
+    """
+    results = {mode: run_story_benchmark(runs, mode=mode) for mode in modes}
+    return compare_to_baseline(results, "sections")
+
+# --------------------------------------------------------
+# READABILITY SCORING BENCHMARK
+# --------------------------------------------------------
+
+def benchmark_readability(folder=STORIES_DIR, repeat=1, max_workers=None):
+    """
+    Compares the previous per-call textstat scoring with `readability.score_text`.
+
+    - textstat: `flesch_reading_ease` + `flesch_kincaid_grade` + `len(text.split())` per story.
+    - readability: one `score_text` call per story (warm syllable cache after the first pass),
+      and the process-pool batch API.
+    - Reports the largest score difference between the two engines.
+
+    Parameters:
+        folder (str): Folder with stored `story_*_full.txt` files.
+        repeat (int): How many times the stored stories are scored (simulates bulk validation).
+        max_workers (int, optional): Worker processes for the batch API.
+
+    Returns:
+        dict: Seconds per engine, speedups and the maximum score difference.
+    """
+    paths = sorted(glob.glob(os.path.join(folder, "story_*_full.txt")))
+    if not paths:
+        raise SystemExit(f"No stored stories found in {folder}.")
+    texts = [readability.read_text(path) for path in paths] * repeat
+
+    readability.load_cmudict()  # Exclude one-time dictionary loading from the timings
+    textstat.flesch_reading_ease("Warm up the dictionary.")
+
+    # textstat memoizes on the exact text, so each text is made unique to time real work
+    start = time.perf_counter()
+    baseline = [
+        (textstat.flesch_reading_ease(text + " " * i), textstat.flesch_kincaid_grade(text + " " * i), len(text.split()))
+        for i, text in enumerate(texts)
+    ]
+    textstat_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = [readability.score_text(text) for text in texts]
+    single_pass_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    readability.score_texts(texts, max_workers=max_workers)
+    batch_seconds = time.perf_counter() - start
+
+    max_difference = max(
+        max(abs(old[0] - new.flesch_reading_ease), abs(old[1] - new.flesch_kincaid_grade))
+        for old, new in zip(baseline, scores)
+    )
+
+    return {
+        "stories": len(texts),
+        "textstat_seconds": textstat_seconds,
+        "single_pass_seconds": single_pass_seconds,
+        "batch_seconds": batch_seconds,
+        "single_pass_speedup": textstat_seconds / single_pass_seconds,
+        "batch_speedup": textstat_seconds / batch_seconds,
+        "max_score_difference": max_difference,
+    }
+
+# --------------------------------------------------------
+# MUSIC TEXT CONDITIONING BENCHMARK
+# --------------------------------------------------------
+
+def benchmark_music_conditioning(clips=4, max_new_tokens=100):
+    """
+    Measures the per-clip latency saved by the MusicGen text conditioning cache on CPU.
+
+    - Warms the cache for every (setting, music prompt) pair of the metadata.
+    - For each of the first `clips` prompts, times a generate call that tokenizes and
+      encodes the prompt itself and one fed from the cache, with the
+      same seed and length, after one untimed warm-up call.
+
+    Parameters:
+        clips (int): Number of prompts timed.
+        max_new_tokens (int): Audio tokens per clip (100 = 2 s, as in `generate_music`).
+
+    Returns:
+        dict: Mean seconds per clip with and without the cache, the seconds saved, and
+        the mean text encoder time.
+    """
+    import torch
+    import music_gen  # Loads torch/transformers only for this benchmark
+
+    settings = load_metadata(METADATA_PATH)["settings"]
+    descriptions = {key: setting["description"] for key, setting in settings.items()}
+
+    start = time.perf_counter()
+    warmed = music_gen.warm_conditioning_cache(descriptions)
+    warm_seconds = time.perf_counter() - start
+
+    prompts = [
+        music_gen.format_music_prompt(prompt_key, setting_key, description)
+        for setting_key, description in descriptions.items()
+        for prompt_key in music_gen.PROMPTS
+    ][:clips]
+    generate_kwargs = {"do_sample": True, "guidance_scale": music_gen.GUIDANCE_SCALE, "max_new_tokens": max_new_tokens}
+
+    uncached, cached, encoder = [], [], []
+    with music_gen.music_model.use() as model, torch.no_grad():
+        model.generate(**music_gen.conditioning_inputs(model, prompts[0]), **generate_kwargs)
+
+        for prompt in prompts:
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            model.generate(**music_gen.processor(text=[prompt], padding=True, return_tensors="pt"), **generate_kwargs)
+            uncached.append(time.perf_counter() - start)
+
+            torch.manual_seed(0)
+            start = time.perf_counter()
+            model.generate(**music_gen.conditioning_inputs(model, prompt), **generate_kwargs)
+            cached.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            music_gen.encode_prompt(model, prompt)
+            encoder.append(time.perf_counter() - start)
+
+    mean = lambda values: sum(values) / len(values)
+    return {
+        "prompts_warmed": warmed,
+        "warm_seconds": warm_seconds,
+        "clips": len(prompts),
+        "max_new_tokens": max_new_tokens,
+        "uncached_clip_seconds": mean(uncached),
+        "cached_clip_seconds": mean(cached),
+        "saved_seconds_per_clip": mean(uncached) - mean(cached),
+        "text_encoder_seconds": mean(encoder),
+    }
+
+# --------------------------------------------------------
+# COMMAND LINE ENTRY POINT
+# --------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the storyteller pipeline.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    story_parser = subparsers.add_parser("story", help="Serial vs. speculative parallel story generation.")
+    story_parser.add_argument("--runs", type=int, default=20)
+    story_parser.add_argument("--candidates", type=int, nargs="+", default=[1, 2, 3])
+
+    modes_parser = subparsers.add_parser("story-modes", help="Three-call vs. single-call story generation.")
+    modes_parser.add_argument("--runs", type=int, default=20)
+    modes_parser.add_argument("--modes", nargs="+", default=["sections", "single_call"])
+
+    readability_parser = subparsers.add_parser("readability", help="textstat vs. single-pass readability scoring.")
+    readability_parser.add_argument("--folder", default=STORIES_DIR)
+    readability_parser.add_argument("--repeat", type=int, default=1)
+    readability_parser.add_argument("--workers", type=int, default=None)
+
+    music_parser = subparsers.add_parser("music-conditioning", help="MusicGen clips with vs. without cached text encoding.")
+    music_parser.add_argument("--clips", type=int, default=4)
+    music_parser.add_argument("--max-new-tokens", type=int, default=100)
+
+    args = parser.parse_args()
+
+    if args.benchmark == "story":
+        print(json.dumps(benchmark_story(args.runs, args.candidates), indent=2))
+    elif args.benchmark == "story-modes":
+        print(json.dumps(benchmark_story_modes(args.runs, args.modes), indent=2))
+    elif args.benchmark == "readability":
+        print(json.dumps(benchmark_readability(args.folder, args.repeat, args.workers), indent=2))
+    elif args.benchmark == "music-conditioning":
+        print(json.dumps(benchmark_music_conditioning(args.clips, args.max_new_tokens), indent=2))
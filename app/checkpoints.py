@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+from contextlib import closing
+import metrics
+from config import CHECKPOINT_DB, CHECKPOINT_MAX_AGE_SECONDS
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# PIPELINE STAGE CHECKPOINTS
+# --------------------------------------------------------
+# After each completed stage `full_pipeline` records what it produced (story files,
+# validated narration paths, music clips) in a local SQLite database. A retry with the
+# same inputs from the same Gradio session, handled by this or any other worker process
+# on the host, continues after the last completed stage instead of starting over. Other
+# sessions never see the checkpoint, even with identical inputs. It is deleted once the
+# final audio is written.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    request_key TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    result TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (request_key, stage)
+)
+"""
+
+def request_key(session_hash, setting_key, selected_characters, theme_key):
+    """
+    Identifies a pipeline request by its session and inputs.
+
+    Only a retry from the same session resumes the request. Character order does not
+    change the request, so the characters are sorted.
+
+    Parameters:
+        session_hash (str or None): Gradio session that made the request.
+
+    Returns:
+        str or None: A hex SHA-256 digest, or None (no checkpointing) without a session.
+    """
+    if session_hash is None:
+        return None
+    inputs = {"session": session_hash, "setting": setting_key,
+              "characters": sorted(selected_characters), "theme": theme_key}
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+def connect(db_path=CHECKPOINT_DB):
+    """
+    Opens the checkpoint database, creating it if needed.
+
+    WAL mode lets several worker processes read while one writes; the busy timeout
+    makes concurrent writers wait for each other instead of failing.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    connection = sqlite3.connect(db_path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(SCHEMA)
+    return connection
+
+def stage_paths(result):
+    """
+    Returns every file path referenced by a stage result (str, list or dict of paths).
+
+    A missing entry (None) is returned as None, so the result counts as incomplete.
+    """
+    if result is None:
+        return [None]
+    if isinstance(result, str):
+        return [result]
+    if isinstance(result, dict):
+        values = result.values()
+    elif isinstance(result, list):
+        values = result
+    else:
+        return []
+    return [path for value in values for path in stage_paths(value)]
+
+def save_checkpoint(key, stage, result, db_path=CHECKPOINT_DB):
+    """
+    Records the result of a completed stage.
+
+    Parameters:
+        key (str): Request key from `request_key`.
+        stage (str): Stage name ("story", "narration", "music").
+        result (dict or list): JSON-serializable stage output (file paths).
+    """
+    if key is None:
+        return
+    try:
+        with closing(connect(db_path)) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO checkpoints (request_key, stage, result, updated_at) VALUES (?, ?, ?, ?)",
+                (key, stage, json.dumps(result), time.time())
+            )
+        metrics.increment("checkpoint.saved")
+    except sqlite3.Error as e:
+        # Checkpoints are an optimization; the pipeline carries on without them
+        logging.error(f"Failed to save {stage} checkpoint: {e}")
+
+def load_checkpoint(key, db_path=CHECKPOINT_DB, max_age_seconds=CHECKPOINT_MAX_AGE_SECONDS):
+    """
+    Loads the completed stages of a request, ignoring any that are incomplete or whose
+    files no longer exist.
+
+    Checkpoints older than `max_age_seconds` are discarded (for every request).
+
+    Returns:
+        dict: Stage name -> stage result; empty if there is nothing to resume.
+    """
+    if key is None:
+        return {}
+    try:
+        with closing(connect(db_path)) as connection, connection:
+            connection.execute("DELETE FROM checkpoints WHERE updated_at < ?", (time.time() - max_age_seconds,))
+            rows = connection.execute(
+                "SELECT stage, result FROM checkpoints WHERE request_key = ?", (key,)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to load checkpoint: {e}")
+        return {}
+
+    stages = {}
+    for stage, result in rows:
+        result = json.loads(result)
+        missing = [path for path in stage_paths(result) if path is None or not os.path.exists(path)]
+        if missing:
+            logging.warning(f"Ignoring {stage} checkpoint, files are gone: {missing}")
+            continue
+        stages[stage] = result
+    return stages
+
+def clear_checkpoint(key, stages=None, db_path=CHECKPOINT_DB):
+    """
+    Deletes the stage checkpoints of a request.
+
+    Parameters:
+        key (str): Request key from `request_key`.
+        stages (list, optional): Stages to forget (e.g. because their files were
+            removed); every stage when omitted, as once the pipeline completed.
+    """
+    if key is None:
+        return
+    try:
+        with closing(connect(db_path)) as connection, connection:
+            if stages is None:
+                connection.execute("DELETE FROM checkpoints WHERE request_key = ?", (key,))
+            else:
+                connection.executemany("DELETE FROM checkpoints WHERE request_key = ? AND stage = ?",
+                                       [(key, stage) for stage in stages])
+    except sqlite3.Error as e:
+        logging.error(f"Failed to clear checkpoint: {e}")
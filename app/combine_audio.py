@@ -1,9 +1,10 @@
 import os
 import logging
 import numpy as np
-from datetime import datetime
 import scipy.io.wavfile as wavfile
-from config import FINAL_AUDIO_DIR
+from config import FINAL_AUDIO_DIR, MUSIC_UNDERLAY_GAIN
+from workers import cancelled
+from profiling import new_request_id
 import librosa
 import soundfile as sf
 
@@ -66,11 +67,55 @@ def load_wav_as_float32(file_path, target_sample_rate=None):
         num_samples = int(FALLBACK_DURATION * target_sample_rate) if target_sample_rate else 0
         return target_sample_rate, np.zeros(num_samples, dtype=np.float32)
 
+def get_narration_durations(narration_paths):
+    """
+    Returns the length in seconds of the beginning, middle and ending narrations.
+
+    Returns:
+        dict: Section name -> duration in seconds.
+    """
+    return {
+        section: librosa.get_duration(path=path)
+        for section, path in zip(["beginning", "middle", "ending"], narration_paths)
+    }
+
+def save_final_audio(combined_audio_float, sr, request_id=None):
+    """
+    Normalizes the final mix and saves it as a 16-bit WAV file.
+
+    Parameters:
+        request_id (str, optional): Pipeline request id used in the file name
+            (a new unique id when omitted).
+
+    Returns:
+        str: Path to the saved file.
+    """
+    # Normalize the final mix to prevent clipping
+    max_abs_value = np.max(np.abs(combined_audio_float))
+    if max_abs_value > 1.0:
+        logging.info(f"Normalizing audio to avoid clipping. Peak before: {max_abs_value:.2f}")
+        combined_audio_float /= max_abs_value
+    else:
+        logging.info(f"No normalization needed. Peak amplitude: {max_abs_value:.2f}")
+
+    # Convert float32 to int16 for WAV saving (scaling from [-1,1] to [-32767, 32767])
+    combined_audio_int16 = (combined_audio_float * 32767).astype(np.int16)
+
+    # Save the final combined audio file
+    request_id = request_id or new_request_id()
+    final_audio_path = os.path.join(FINAL_AUDIO_DIR, f"final_story_audio_{request_id}.wav")
+    wavfile.write(final_audio_path, sr, combined_audio_int16)
+
+    duration_seconds = len(combined_audio_float) / sr
+    logging.info(f"Final combined audio saved at: {final_audio_path} (Duration: {duration_seconds:.2f}s)")
+
+    return final_audio_path
+
 # --------------------------------------------------------
 # AUDIO COMBINATION FUNCTION
 # --------------------------------------------------------
 
-def combine_audio(narration_paths, music_paths):
+def combine_audio(narration_paths, music_paths, request_id=None):
     """
     Combines narration and background music into a single audio track.
     
@@ -82,6 +127,7 @@ def combine_audio(narration_paths, music_paths):
     Parameters:
         narration_paths (list): List of file paths for the narration audio.
         music_paths (dict): Dictionary of file paths for background music.
+        request_id (str, optional): Pipeline request id used in the output file name.
 
     Returns:
         str: Path to the final combined audio file.
@@ -120,26 +166,99 @@ def combine_audio(narration_paths, music_paths):
             music_ending, silence
         ], dtype=np.float32)
 
-        # 5) Normalize the final mix to prevent clipping
-        max_abs_value = np.max(np.abs(combined_audio_float))
-        if max_abs_value > 1.0:
-            logging.info(f"Normalizing audio to avoid clipping. Peak before: {max_abs_value:.2f}")
-            combined_audio_float /= max_abs_value
-        else:
-            logging.info(f"No normalization needed. Peak amplitude: {max_abs_value:.2f}")
+        # 5) Normalize and save the final mix, unless the request was abandoned meanwhile
+        if cancelled():
+            logging.info("Audio merging cancelled.")
+            return None
+        return save_final_audio(combined_audio_float, sr, request_id)
+
+    except Exception as e:
+        logging.error(f"Error while combining audio: {e}")
+        return None
+
+# --------------------------------------------------------
+# UNDERLAY MIXING FUNCTION (LONG-FORM MUSIC)
+# --------------------------------------------------------
+
+def mix_music_stream(narration, sr, music_stream, music_sr, gain=MUSIC_UNDERLAY_GAIN):
+    """
+    Mixes a stream of music windows underneath one narration section.
+
+    - Each window is resampled and added to the narration as soon as it is produced.
+    - The stream is closed once the narration is covered, so no extra music is generated.
+    - Short fades at both ends avoid clicks.
+
+    Parameters:
+        narration (np.ndarray): Float32 narration samples at `sr`.
+        sr (int): Sample rate of the narration.
+        music_stream (iterator): Float32 music windows at `music_sr`.
+        music_sr (int): Sample rate of the music windows.
+        gain (float): Music volume relative to the narration.
+
+    Returns:
+        np.ndarray: The mixed section.
+    """
+    mixed = narration.copy()
+    position = 0
+
+    try:
+        for window in music_stream:
+            if music_sr != sr:
+                window = librosa.resample(window, orig_sr=music_sr, target_sr=sr)
+            window = window[:len(mixed) - position]
+            mixed[position:position + len(window)] += gain * window
+            position += len(window)
+            if position >= len(mixed):
+                break
+    finally:
+        music_stream.close()
+
+    # Fade the music in and out over half a second
+    fade = min(int(sr * 0.5), position // 2)
+    if fade:
+        music_part = mixed[:position] - narration[:position]
+        ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)
+        music_part[:fade] *= ramp
+        music_part[position - fade:] *= ramp[::-1]
+        mixed[:position] = narration[:position] + music_part
+
+    return mixed
 
-        # 6) Convert float32 to int16 for WAV saving (scaling from [-1,1] to [-32767, 32767])
-        combined_audio_int16 = (combined_audio_float * 32767).astype(np.int16)
+def combine_audio_underlay(narration_paths, music_streams, music_sr, request_id=None):
+    """
+    Combines narration with long-form background music playing underneath it.
+
+    Parameters:
+        narration_paths (list): File paths for the beginning, middle and ending narration.
+        music_streams (dict): Section name -> iterator of music windows (see `music_gen.stream_music`).
+        music_sr (int): Sample rate of the music windows.
+        request_id (str, optional): Pipeline request id used in the output file name.
+
+    Returns:
+        str: Path to the final combined audio file, or None if it failed or the
+        request was cancelled while the music was being generated.
+    """
+
+    logging.info("Starting final audio merging process (music underlay)...")
+
+    try:
+        # Use the first narration file as the target sample rate
+        sr, _ = load_wav_as_float32(narration_paths[0], None)
+        logging.info(f"Using {sr} Hz as target sample rate for merging.")
 
-        # 7) Save the final combined audio file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        final_audio_path = os.path.join(FINAL_AUDIO_DIR, f"final_story_audio_{timestamp}.wav")
-        wavfile.write(final_audio_path, sr, combined_audio_int16)
+        silence = np.zeros(int(sr * 0.5), dtype=np.float32)
+        parts = [silence]
 
-        duration_seconds = len(combined_audio_float) / sr
-        logging.info(f"Final combined audio saved at: {final_audio_path} (Duration: {duration_seconds:.2f}s)")
+        for section, narration_path in zip(["beginning", "middle", "ending"], narration_paths):
+            _, narration = load_wav_as_float32(narration_path, sr)
+            parts.append(mix_music_stream(narration, sr, music_streams[section], music_sr))
+            parts.append(silence)
+            if cancelled():
+                logging.info("Audio merging cancelled.")
+                return None
 
-        return final_audio_path
+        combined_audio_float = np.concatenate(parts, dtype=np.float32)
+        return save_final_audio(combined_audio_float, sr, request_id)
 
     except Exception as e:
         logging.error(f"Error while combining audio: {e}")
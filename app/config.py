@@ -9,11 +9,57 @@ STORIES_DIR = os.path.join(BASE_DIR, "../generated/stories/")
 NARRATIONS_DIR = os.path.join(BASE_DIR, "../generated/narrations/")
 MUSIC_DIR = os.path.join(BASE_DIR, "../generated/music/")
 FINAL_AUDIO_DIR = os.path.join(BASE_DIR, "../generated/final_audio/")
+PROFILES_DIR = os.path.join(BASE_DIR, "../generated/profiles/")
+MODELS_DIR = os.path.join(BASE_DIR, "../generated/models/")
+CHECKPOINT_DB = os.path.join(BASE_DIR, "../generated/checkpoints.db")
 LICENSE_DIR = os.path.join(BASE_DIR, "../licenses/")
 LICENSE_LLAMA = os.path.join(LICENSE_DIR, "llama3_1_license.txt")
 LICENSE_MELO = os.path.join(LICENSE_DIR, "melotts_license.txt")
 LICENSE_MUSIC = os.path.join(LICENSE_DIR, "musicgen_license.txt")
 
+# Concurrency
+TORCH_THREADS = min(4, os.cpu_count() or 1)  # Intra-op threads per torch operator (each MusicGen call keeps several cores)
+CPU_WORKERS = max(1, (os.cpu_count() or 1) // TORCH_THREADS)  # Threads for CPU-bound stages (MusicGen, validation, mixing)
+MAX_CONCURRENT_SESSIONS = None  # Gradio sessions served at once; None = no limit (bounded by CPU_WORKERS instead)
+
+# Time budgets
+REQUEST_DEADLINE_SECONDS = 600  # End-to-end budget for one full_pipeline run
+LLM_CALL_TIMEOUT_SECONDS = 240  # Longest a healthy LLM takes for one call; slower calls count as backend failures
+TTS_CALL_TIMEOUT_SECONDS = 120  # Longest a healthy TTS service takes for one text; slower calls count as backend failures
+CIRCUIT_BREAKER_FAILURES = 3  # Consecutive backend failures before calls are short-circuited
+CIRCUIT_BREAKER_RESET_SECONDS = 60  # How long a failing backend is skipped before it is probed again
+
+# Profiling
+PROFILE_SAMPLE_RATE = 0.0  # Fraction of requests profiled (0 = off, 1 = every request)
+
+# Checkpoints
+CHECKPOINT_MAX_AGE_SECONDS = 24 * 3600  # Unfinished requests older than this start over instead of resuming
+
+# LLM and TTS backends
+LLM_BACKEND = "cli"  # "cli" = `ollama run` subprocess; "http" = Ollama HTTP API
+LLM_MODEL = "llama3.1"
+OLLAMA_URL = "http://localhost:11434/api/generate"
+TTS_URL = "http://localhost:8888/convert/tts"
+
+# Story generation
+STORY_MAX_ATTEMPTS = 5  # Maximum number of story candidates generated per request
+STORY_MAX_PARALLEL_CANDIDATES = 1  # 1 = serial retries; >1 = race up to this many candidates against the LLM
+STORY_TARGET_SUCCESS_RATE = 0.9  # Desired probability that at least one in-flight candidate passes validation
+STORY_GENERATION_MODE = "sections"  # "sections" = one LLM call per section; "single_call" = whole story in one call
+
+# Music generation
+MUSIC_MODE = "clips"  # "clips" = short clips between narrations; "underlay" = music under each narration section
+MUSIC_WINDOW_SECONDS = 10  # Length of each newly generated window in underlay mode
+MUSIC_CONTEXT_SECONDS = 3  # Tail of the previous window used as audio prompt for the next one
+MUSIC_UNDERLAY_GAIN = 0.25  # Volume of the underlay music relative to the narration
+
+# MusicGen model lifecycle
+MUSIC_MODEL_NAME = "facebook/musicgen-small"
+MUSIC_MODEL_IDLE_SECONDS = 900  # Unload MusicGen after this long without a request; None = keep it loaded
+MUSIC_MMAP_WEIGHTS = True  # Load MusicGen from a memory-mapped local weights file (pages shared between processes)
+MUSIC_WEIGHTS_DIR = os.path.join(MODELS_DIR, "weights/")  # Memory-mapped weights, saved as <model name>/<revision>.safetensors
+MUSIC_CONDITIONING_DIR = os.path.join(MODELS_DIR, "conditioning/")  # Cached text-encoder outputs per prompt and model revision
+
 
 
 INSTRUMENTS_BY_SETTING = {
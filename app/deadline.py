@@ -0,0 +1,142 @@
+import time
+import logging
+import threading
+import metrics
+from config import REQUEST_DEADLINE_SECONDS, CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_SECONDS
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# PER-REQUEST DEADLINE
+# --------------------------------------------------------
+
+class Deadline:
+    """
+    Time budget for one pipeline request, passed down to every stage and retry loop.
+
+    - `remaining()` is used as the timeout for backend calls.
+    - `can_afford(metric)` tells a retry loop whether a typical attempt (the median of the
+      timing `metric` recorded so far) still fits in the budget.
+    """
+
+    def __init__(self, seconds=REQUEST_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """Returns the number of seconds left (never negative)."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        """Returns True once the budget is used up."""
+        return self.remaining() <= 0
+
+    def can_afford(self, metric):
+        """
+        Checks whether a typical attempt of a stage still fits in the remaining budget.
+
+        Parameters:
+            metric (str): Name of the timing metric holding previous attempt durations.
+
+        Returns:
+            bool: False if the budget is spent or smaller than the median attempt duration.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            return False
+
+        typical = metrics.percentile(metric, 50)
+        if typical is not None and typical > remaining:
+            logging.warning(f"Skipping attempt: typical {metric} ({typical:.1f}s) exceeds remaining budget ({remaining:.1f}s).")
+            metrics.increment("deadline.attempts_skipped")
+            return False
+        return True
+
+def remaining_or_none(deadline):
+    """Returns the remaining seconds of `deadline`, or None (no timeout) if there is no deadline."""
+    return deadline.remaining() if deadline is not None else None
+
+def backend_call_timeout(deadline, backend_timeout):
+    """
+    Returns the timeout for one backend call: the backend's own limit, shortened to the
+    remaining request budget when that is smaller.
+
+    Only a call stopped by the backend's own limit says the backend is unhealthy; a call
+    cut short by a nearly spent request budget must not count against its circuit breaker.
+
+    Parameters:
+        deadline (Deadline or None): Request budget.
+        backend_timeout (float): Longest a healthy backend takes for one call.
+
+    Returns:
+        tuple: (timeout in seconds, True if reaching it is a backend failure)
+    """
+    remaining = remaining_or_none(deadline)
+    if remaining is None or backend_timeout <= remaining:
+        return backend_timeout, True
+    return remaining, False
+
+# --------------------------------------------------------
+# CIRCUIT BREAKERS FOR BACKENDS
+# --------------------------------------------------------
+
+class CircuitBreaker:
+    """
+    Stops calling a backend that keeps failing.
+
+    - After `failure_threshold` consecutive failures the circuit opens and `allow()`
+      returns False, so callers fail fast instead of retrying.
+    - After `reset_seconds` calls are allowed again; one success closes the circuit,
+      another failure re-opens it for a new period.
+    """
+
+    def __init__(self, name, failure_threshold=CIRCUIT_BREAKER_FAILURES, reset_seconds=CIRCUIT_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Returns True if the backend may be called."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return True  # Half-open: let calls probe the backend again
+
+        metrics.increment(f"circuit.{self.name}.short_circuited")
+        return False
+
+    def record_success(self):
+        """Closes the circuit after a successful call."""
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f"Circuit for {self.name} closed again.")
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        """Counts a failed call and opens the circuit once the threshold is reached."""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logging.error(f"Circuit for {self.name} opened after {self._failures} consecutive failures.")
+                    metrics.increment(f"circuit.{self.name}.opened")
+                self._opened_at = time.monotonic()
+
+# One breaker per backend, shared by all requests in the process
+BREAKERS = {
+    "llm": CircuitBreaker("llm"),
+    "tts": CircuitBreaker("tts"),
+    "music": CircuitBreaker("music"),
+}
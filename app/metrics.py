@@ -0,0 +1,101 @@
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# IN-PROCESS METRICS REGISTRY
+# --------------------------------------------------------
+
+# Number of recent samples kept per timing metric (enough for stable p95 values)
+MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(float)
+_timings = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_gauges = {}
+
+def increment(name, value=1):
+    """Adds `value` to the counter called `name`."""
+    with _lock:
+        _counters[name] += value
+
+def observe(name, value):
+    """Records one sample (usually a duration in seconds) for the timing called `name`."""
+    with _lock:
+        _timings[name].append(value)
+
+def set_gauge(name, value):
+    """Sets the gauge called `name` to its latest value (e.g. current memory use)."""
+    with _lock:
+        _gauges[name] = value
+
+def get_counter(name):
+    """Returns the current value of a counter (0 if it was never incremented)."""
+    with _lock:
+        return _counters.get(name, 0)
+
+def percentile(name, q):
+    """
+    Returns the q-th percentile (0–100) of the recorded samples for `name`.
+
+    Returns:
+        float or None: The percentile value, or None if no samples were recorded.
+    """
+    with _lock:
+        samples = sorted(_timings.get(name, ()))
+    if not samples:
+        return None
+    index = min(len(samples) - 1, max(0, int(round(q / 100 * (len(samples) - 1)))))
+    return samples[index]
+
+@contextmanager
+def timed(name):
+    """Context manager that records the wall-clock duration of its block under `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+def snapshot():
+    """
+    Returns a copy of all metrics.
+
+    Returns:
+        dict: {"counters": {...}, "gauges": {...}, "timings": {name: {"count", "mean", "p50", "p95"}}}
+    """
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        timing_names = list(_timings)
+
+    timings = {}
+    for name in timing_names:
+        with _lock:
+            samples = list(_timings[name])
+        if samples:
+            timings[name] = {
+                "count": len(samples),
+                "mean": sum(samples) / len(samples),
+                "p50": percentile(name, 50),
+                "p95": percentile(name, 95),
+            }
+    return {"counters": counters, "gauges": gauges, "timings": timings}
+
+def reset():
+    """Clears all counters and timings (used by benchmarks between runs)."""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+        _gauges.clear()
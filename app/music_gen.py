@@ -1,13 +1,32 @@
 import os
+import gc
+import asyncio
 import torch
+import hashlib
+import tempfile
 import logging
 import librosa
 import numpy as np
 import time
+import threading
 import scipy.io.wavfile as wavfile
-from transformers import AutoProcessor, MusicgenForConditionalGeneration
-from datetime import datetime
-from config import MUSIC_DIR, PROMPT_DIR, INSTRUMENTS_BY_SETTING
+from transformers import (
+    AutoProcessor, GenerationConfig, MusicgenConfig, MusicgenForConditionalGeneration,
+    StoppingCriteria, StoppingCriteriaList,
+)
+from transformers.modeling_outputs import BaseModelOutput
+from contextlib import contextmanager
+import metrics
+from weights import export_weights, load_weights_mmap, assign_weights, resident_memory_bytes
+from deadline import BREAKERS, remaining_or_none
+from singleflight import SingleFlight
+from workers import run_cpu, cancelled
+from profiling import torch_operator_profile, new_request_id
+from config import (
+    MUSIC_DIR, PROMPT_DIR, INSTRUMENTS_BY_SETTING,
+    MUSIC_WINDOW_SECONDS, MUSIC_CONTEXT_SECONDS,
+    TORCH_THREADS, MUSIC_MODEL_NAME, MUSIC_MODEL_IDLE_SECONDS, MUSIC_MMAP_WEIGHTS, MUSIC_WEIGHTS_DIR, MUSIC_CONDITIONING_DIR,
+)
 
 # --------------------------------------------------------
 # LOGGING CONFIGURATION
@@ -22,9 +41,167 @@ logging.basicConfig(
 # LOAD MUSICGEN MODEL
 # --------------------------------------------------------
 
-# Load the MusicGen processor and model for conditional music generation
-processor = AutoProcessor.from_pretrained("facebook/musicgen-small")
-model = MusicgenForConditionalGeneration.from_pretrained("facebook/musicgen-small", attn_implementation="eager")
+# torch's intra-op pool is shared by every executor thread. CPU_WORKERS x TORCH_THREADS
+# matches the core count, so one generation still uses several cores while concurrent
+# ones do not oversubscribe the CPU
+torch.set_num_threads(TORCH_THREADS)
+
+# The processor (tokenizer + feature extractor) is small and stays loaded
+processor = AutoProcessor.from_pretrained(MUSIC_MODEL_NAME)
+
+def load_model_from_pretrained(revision=None):
+    """Loads MusicGen the regular way (weights copied into process memory)."""
+    return MusicgenForConditionalGeneration.from_pretrained(MUSIC_MODEL_NAME, revision=revision,
+                                                            attn_implementation="eager")
+
+def weights_path(revision, weights_dir=MUSIC_WEIGHTS_DIR):
+    """Returns the local safetensors file holding MusicGen's weights at `revision`."""
+    return os.path.join(weights_dir, MUSIC_MODEL_NAME, f"{revision}.safetensors")
+
+def load_model_mmap(weights_dir=MUSIC_WEIGHTS_DIR):
+    """
+    Loads MusicGen with its weights memory-mapped from a local safetensors file.
+
+    The modules are built on the meta device (no memory, no random init) and their
+    parameters are then pointed at the mapped file. The file is named after the model
+    and its checkpoint revision, so a new revision is exported to a new file on first
+    use instead of reusing stale weights.
+
+    Parameters:
+        weights_dir (str): Directory of the exported weight files.
+
+    Returns:
+        MusicgenForConditionalGeneration: The model, ready for inference.
+
+    Raises:
+        ValueError: If the checkpoint revision is unknown or the file does not fit the model.
+    """
+    config = MusicgenConfig.from_pretrained(MUSIC_MODEL_NAME)
+    revision = getattr(config, "_commit_hash", None)
+    if not revision:
+        raise ValueError(f"Unknown revision of {MUSIC_MODEL_NAME}, cannot pick a weights file")
+
+    path = weights_path(revision, weights_dir)
+    if not os.path.exists(path):
+        logging.info(f"Exporting MusicGen weights to {path} for memory-mapped loading...")
+        export_weights(load_model_from_pretrained(revision), path)
+        gc.collect()
+
+    with torch.device("meta"):
+        model = MusicgenForConditionalGeneration._from_config(config, attn_implementation="eager")
+
+    tensors, aliases = load_weights_mmap(path)
+    assign_weights(model, tensors, aliases)
+    model.generation_config = GenerationConfig.from_pretrained(MUSIC_MODEL_NAME)
+    return model
+
+class MusicModel:
+    """
+    Loads MusicGen on first use and unloads it after `idle_seconds` without a request.
+
+    Callers borrow the model with `use()`; it is never unloaded while borrowed. A
+    background thread checks for idleness, and the next `use()` after an eviction
+    reloads it (from memory-mapped weights when MUSIC_MMAP_WEIGHTS is on, so the reload
+    is fast and the pages are shared with other processes using the same file).
+
+    Metrics:
+        music.model_loads         Loads, including the first one.
+        music.model_reloads       Loads after an eviction.
+        music.model_evictions     Idle unloads.
+        music.model_load_seconds  Load latency.
+        process.resident_bytes    Resident memory after each load / eviction (gauge).
+    """
+
+    def __init__(self, idle_seconds=MUSIC_MODEL_IDLE_SECONDS, mmap_weights=MUSIC_MMAP_WEIGHTS):
+        self.idle_seconds = idle_seconds
+        self.mmap_weights = mmap_weights
+        self._model = None
+        self._users = 0
+        self._last_used = time.monotonic()
+        self._loads = 0
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    @contextmanager
+    def use(self):
+        """Borrows the model (loading it if needed) for the duration of the block."""
+        with self._lock:
+            if self._model is None:
+                self._model = self._load()
+                self._start_reaper()
+            model = self._model
+            self._users += 1
+        try:
+            yield model
+        finally:
+            with self._lock:
+                self._users -= 1
+                self._last_used = time.monotonic()
+
+    def _load(self):
+        start = time.perf_counter()
+        model = None
+        if self.mmap_weights:
+            try:
+                model = load_model_mmap()
+            except Exception as e:
+                logging.warning(f"Memory-mapped MusicGen load failed, loading from the checkpoint instead: {e}")
+        if model is None:
+            model = load_model_from_pretrained()
+        model.eval()
+
+        elapsed = time.perf_counter() - start
+        metrics.observe("music.model_load_seconds", elapsed)
+        metrics.increment("music.model_loads")
+        if self._loads:
+            metrics.increment("music.model_reloads")
+        self._loads += 1
+        metrics.set_gauge("process.resident_bytes", resident_memory_bytes())
+        logging.info(f"MusicGen loaded in {elapsed:.2f}s.")
+        return model
+
+    def _start_reaper(self):
+        if self.idle_seconds is None or self._reaper is not None:
+            return
+        self._reaper = threading.Thread(target=self._reap, name="musicgen-idle-evictor", daemon=True)
+        self._reaper.start()
+
+    def _reap(self):
+        interval = max(1.0, min(60.0, self.idle_seconds / 4))
+        while True:
+            time.sleep(interval)
+            self.evict_if_idle()
+
+    def evict_if_idle(self):
+        """
+        Unloads the model if nobody is using it and it has been idle for `idle_seconds`.
+
+        Returns:
+            bool: True if the model was unloaded.
+        """
+        with self._lock:
+            idle_for = time.monotonic() - self._last_used
+            if self._model is None or self._users or idle_for < self.idle_seconds:
+                return False
+            self._model = None
+
+        gc.collect()
+        metrics.increment("music.model_evictions")
+        metrics.set_gauge("process.resident_bytes", resident_memory_bytes())
+        logging.info(f"MusicGen unloaded after {idle_for:.0f}s idle.")
+        return True
+
+music_model = MusicModel()
+
+class StopWhenCancelled(StoppingCriteria):
+    """Ends `generate` at the next decoding step once the request awaiting it is cancelled."""
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.full((input_ids.shape[0],), cancelled(), dtype=torch.bool, device=input_ids.device)
+
+def stop_if_cancelled():
+    """Returns a fresh stopping-criteria list for `generate` that honours request cancellation."""
+    return StoppingCriteriaList([StopWhenCancelled()])
 
 # --------------------------------------------------------
 # LOAD MUSIC PROMPT TEMPLATES
@@ -49,6 +226,164 @@ PROMPTS = {
 
 EXPECTED_SR = 32000  # Expected sample rate (32kHz)
 MIN_AMPLITUDE = 0.2  # Minimum amplitude to ensure the generated music isn't silent
+FRAME_RATE = 50  # MusicGen audio tokens per second of generated audio
+GUIDANCE_SCALE = 3  # Classifier-free guidance: controls how closely output follows the prompt
+
+# Music prompt used under each narration section in underlay mode
+UNDERLAY_SECTIONS = {
+    "beginning": "beginning",
+    "middle": "transition2",
+    "ending": "ending",
+}
+
+# --------------------------------------------------------
+# TEXT CONDITIONING CACHE
+# --------------------------------------------------------
+# Music prompts are fully determined by the setting (8 settings x 4 templates), so the
+# tokenized prompt and the T5 text-encoder output are computed once per prompt and
+# model revision, kept in memory and saved under MUSIC_CONDITIONING_DIR/<revision>/.
+# They are passed to `generate`, so only the audio decoder runs per clip.
+
+_conditioning_cache = {}
+_conditioning_lock = threading.Lock()
+
+def format_music_prompt(prompt_key, setting_key, setting_description):
+    """Fills a music prompt template with the setting and its instruments."""
+    instruments = INSTRUMENTS_BY_SETTING.get(setting_key, ["soft piano", "harp", "strings"])
+    return PROMPTS[prompt_key].format(
+        setting=setting_key,
+        setting_description=setting_description,
+        instruments=", ".join(instruments)
+    )
+
+def model_revision(model):
+    """Returns the checkpoint revision (commit hash) the model was loaded from, or None if unknown."""
+    return getattr(model.config, "_commit_hash", None)
+
+def encode_prompt(model, prompt_text):
+    """
+    Tokenizes a prompt and runs the MusicGen text encoder on it.
+
+    Returns:
+        dict: input_ids, attention_mask and the encoder's last_hidden_state (batch of 1).
+    """
+    inputs = processor(text=[prompt_text], padding=True, return_tensors="pt")
+    with torch.no_grad():
+        hidden_state = model.text_encoder(
+            input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]
+        ).last_hidden_state
+    return {
+        "input_ids": inputs["input_ids"],
+        "attention_mask": inputs["attention_mask"],
+        "last_hidden_state": hidden_state,
+    }
+
+def save_conditioning(conditioning, path):
+    """
+    Writes a conditioning result to the disk cache atomically.
+
+    Each writer uses its own temporary file, so concurrent misses on the same prompt
+    (from any thread or process) never write to the same file. A failed write only
+    costs the cache entry.
+    """
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                torch.save(conditioning, file)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except OSError as e:
+        logging.warning(f"Could not save conditioning cache file {path}: {e}")
+
+def get_prompt_conditioning(model, prompt_text):
+    """
+    Returns the cached `encode_prompt` result for a prompt, computing it on first use.
+
+    Looks in memory first, then on disk. Results are only saved to disk when the
+    model revision is known, so a different checkpoint never reuses stale outputs.
+
+    Metrics:
+        music.conditioning_cache_hits / _disk_hits / _misses  Where the conditioning came from.
+        music.text_encoder_seconds                           Time spent encoding on a miss.
+    """
+    revision = model_revision(model)
+    prompt_hash = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+    key = (revision, prompt_hash)
+
+    with _conditioning_lock:
+        conditioning = _conditioning_cache.get(key)
+    if conditioning is not None:
+        metrics.increment("music.conditioning_cache_hits")
+        return conditioning
+
+    path = os.path.join(MUSIC_CONDITIONING_DIR, revision, f"{prompt_hash}.pt") if revision else None
+    if path and os.path.exists(path):
+        try:
+            conditioning = torch.load(path, weights_only=True)
+            metrics.increment("music.conditioning_cache_disk_hits")
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable conditioning cache file {path}: {e}")
+
+    if conditioning is None:
+        metrics.increment("music.conditioning_cache_misses")
+        with metrics.timed("music.text_encoder_seconds"):
+            conditioning = encode_prompt(model, prompt_text)
+        if path:
+            save_conditioning(conditioning, path)
+
+    with _conditioning_lock:
+        _conditioning_cache[key] = conditioning
+    return conditioning
+
+def conditioning_inputs(model, prompt_text, guidance_scale=GUIDANCE_SCALE):
+    """
+    Builds the `generate` keyword arguments for a prompt from the conditioning cache.
+
+    Mirrors what MusicGen does itself when given only `input_ids`: with classifier-free
+    guidance, a zeroed "unconditional" copy of the encoder output and attention mask is
+    appended along the batch dimension. `input_ids` stays a batch of 1 so `generate`
+    infers the right batch size; the text encoder is skipped because `encoder_outputs`
+    is given.
+
+    Returns:
+        dict: input_ids, attention_mask and encoder_outputs.
+    """
+    conditioning = get_prompt_conditioning(model, prompt_text)
+    hidden_state = conditioning["last_hidden_state"]
+    attention_mask = conditioning["attention_mask"]
+
+    if guidance_scale is not None and guidance_scale > 1:
+        hidden_state = torch.cat([hidden_state, torch.zeros_like(hidden_state)], dim=0)
+        attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=0)
+
+    return {
+        "input_ids": conditioning["input_ids"],
+        "attention_mask": attention_mask,
+        "encoder_outputs": BaseModelOutput(last_hidden_state=hidden_state),
+    }
+
+def warm_conditioning_cache(setting_descriptions):
+    """
+    Precomputes the conditioning of every (setting, music prompt) pair.
+
+    Parameters:
+        setting_descriptions (dict): Setting key -> description (from the frontend metadata).
+
+    Returns:
+        int: Number of prompts warmed.
+    """
+    count = 0
+    with music_model.use() as model:
+        for setting_key, setting_description in setting_descriptions.items():
+            for prompt_key in PROMPTS:
+                get_prompt_conditioning(model, format_music_prompt(prompt_key, setting_key, setting_description))
+                count += 1
+    logging.info(f"Music conditioning cache warmed for {count} prompts.")
+    return count
 
 # --------------------------------------------------------
 # MUSIC VALIDATION FUNCTION
@@ -93,17 +428,24 @@ def validate_music_clip(file_path):
 # MUSIC GENERATION FUNCTION
 # --------------------------------------------------------
 
-def generate_music(setting_key, setting_description):
+def generate_music(setting_key, setting_description, deadline=None, request_id=None):
     """
     Generates instrumental music clips at 32 kHz based on the story setting.
     
     - Selects appropriate instruments for the setting.
     - Uses the MusicGen model to generate different sections of the background music.
     - Saves and validates the generated music clips.
+    - Caps each generation at the remaining request deadline and skips attempts that
+      no longer fit in it, or that would hit a repeatedly failing model.
+    - Stops between decoding steps, and returns the clips finished so far, once every
+      request waiting for this music has been cancelled.
 
     Parameters:
         setting_key (str): The selected story setting.
         setting_description (str): A description of the setting for better music generation.
+        deadline (Deadline, optional): Request budget shared with the other pipeline stages.
+        request_id (str, optional): Pipeline request id used in the file names
+            (a new unique id when omitted).
 
     Returns:
         dict: A dictionary containing file paths to the generated music clips.
@@ -118,8 +460,8 @@ def generate_music(setting_key, setting_description):
     # Ensure the output directory exists
     os.makedirs(MUSIC_DIR, exist_ok=True)
     
-    # Generate a timestamp for file naming
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    # Unique per request, so concurrent generations never share a file
+    request_id = request_id or new_request_id()
 
     # Join instrument names into a single string for the prompt
     instruments_str = ", ".join(instruments)
@@ -130,9 +472,23 @@ def generate_music(setting_key, setting_description):
     # Maximum attempts for music generation
     MAX_MUSIC_ATTEMPTS = 3
 
+    breaker = BREAKERS["music"]
+
     # Generate music clips for each section (beginning, transitions, ending)
     for key, prompt_template in PROMPTS.items():
         for attempt in range(MAX_MUSIC_ATTEMPTS):
+            if cancelled():
+                logging.info("Music generation cancelled.")
+                metrics.increment("music.generations_cancelled")
+                return music_clips
+            if not breaker.allow():
+                logging.warning(f"Music circuit is open, skipping {key} music.")
+                music_clips[key] = None
+                break
+            if deadline is not None and not deadline.can_afford("music.clip_seconds"):
+                music_clips[key] = None
+                break
+
             try:
                 # Format the prompt using story metadata
                 prompt_text = prompt_template.format(
@@ -142,23 +498,31 @@ def generate_music(setting_key, setting_description):
                 )
                 logging.info(f"Attempt {attempt+1} / {MAX_MUSIC_ATTEMPTS} for {key} music.")
 
-                # Prepare inputs for the MusicGen model
-                inputs = processor(text=[prompt_text], padding=True, return_tensors="pt")
-
-                # Generate audio using the MusicGen model
-                with torch.no_grad():
+                # Generate audio using the MusicGen model (text encoding comes from the cache)
+                start = time.perf_counter()
+                with music_model.use() as model, torch.no_grad(), \
+                        torch_operator_profile(f"{key}_attempt{attempt+1}"):
+                    inputs = conditioning_inputs(model, prompt_text)
                     audio_values = model.generate(
                         **inputs,
                         do_sample=True,  # Enable sampling for variability
-                        guidance_scale=3,  # Controls how closely output follows the prompt
-                        max_new_tokens=100  # Limits the length of generated audio
+                        guidance_scale=GUIDANCE_SCALE,  # Controls how closely output follows the prompt
+                        max_new_tokens=100,  # Limits the length of generated audio
+                        max_time=deadline.remaining() if deadline is not None else None,
+                        stopping_criteria=stop_if_cancelled()
                     )
+                if cancelled():
+                    logging.info(f"Music generation cancelled during {key} music.")
+                    metrics.increment("music.generations_cancelled")
+                    return music_clips  # Discard the partial clip
+                metrics.observe("music.clip_seconds", time.perf_counter() - start)
+                breaker.record_success()
 
                 # Convert audio tensor to NumPy array
                 audio_array = audio_values.cpu().numpy().astype(np.float32)
 
                 # Define the file path for the generated music
-                music_path = os.path.join(MUSIC_DIR, f"music_{key}_{timestamp}.wav")
+                music_path = os.path.join(MUSIC_DIR, f"music_{key}_{request_id}.wav")
 
                 # Save the generated music as a WAV file with a 32 kHz sample rate
                 wavfile.write(music_path, EXPECTED_SR, audio_array)
@@ -172,6 +536,12 @@ def generate_music(setting_key, setting_description):
                     logging.warning(f"❌ Music validation failed for {key}, retrying...")
 
             except Exception as e:
+                if cancelled():
+                    # Stopping mid-generation can leave codes MusicGen cannot decode; not a model failure
+                    logging.info(f"Music generation cancelled during {key} music.")
+                    metrics.increment("music.generations_cancelled")
+                    return music_clips
+                breaker.record_failure()
                 logging.error(f"Error generating {key} music: {e}")
                 if attempt < MAX_MUSIC_ATTEMPTS - 1:
                     logging.info("Retrying music generation after a short delay...")
@@ -182,4 +552,143 @@ def generate_music(setting_key, setting_description):
             logging.error(f"Music generation failed after max attempts for {key}.")
             music_clips[key] = None
 
-    return music_clips
\ No newline at end of file
+    return music_clips
+
+# Music clips depend only on the setting, so concurrent requests for the same setting share one MusicGen run
+music_flights = SingleFlight("music")
+
+async def generate_music_async(setting_key, setting_description, deadline=None, request_id=None):
+    """
+    Awaitable `generate_music` that runs on the CPU executor.
+
+    Concurrent calls for the same setting are coalesced into a single MusicGen pass and
+    all receive the same clip paths (named after the first caller's request id). The
+    shared pass has no deadline of its own: each caller stops waiting at its own
+    deadline, and the pass is cancelled once no caller is left.
+
+    Returns:
+        dict: A dictionary containing file paths to the generated music clips
+        (empty if the deadline was reached first).
+    """
+    try:
+        return await asyncio.wait_for(
+            music_flights.do((setting_key, setting_description), run_cpu, generate_music,
+                             setting_key, setting_description, None, request_id),
+            remaining_or_none(deadline)
+        )
+    except asyncio.TimeoutError:
+        logging.error("Request deadline reached while waiting for music generation.")
+        return {}
+
+# --------------------------------------------------------
+# LONG-FORM (UNDERLAY) MUSIC GENERATION
+# --------------------------------------------------------
+
+def stream_music(prompt_text, duration_seconds, window_seconds=MUSIC_WINDOW_SECONDS,
+                 context_seconds=MUSIC_CONTEXT_SECONDS, deadline=None, label="music"):
+    """
+    Generates music of arbitrary length as a stream of fixed-size windows.
+
+    - The first window is generated from the text prompt only.
+    - Every following window continues from the last `context_seconds` of the previous
+      window (used as audio prompt), so each `generate` call only attends over
+      context + window tokens, no matter how long the total music is.
+    - Windows are produced lazily: the caller can mix each one as it arrives and stop
+      early by closing the generator.
+    - The stream ends early (shorter music) once the request deadline is reached, or
+      mid-window once the request is cancelled.
+
+    Parameters:
+        prompt_text (str): The formatted music prompt.
+        duration_seconds (float): Total length of music to generate.
+        window_seconds (float): Length of newly generated audio per window.
+        context_seconds (float): Length of the audio prompt carried over between windows.
+        deadline (Deadline, optional): Request budget; no new window is started after it expires.
+        label (str): Name used for this stream in logs and profiles.
+
+    Yields:
+        np.ndarray: Float32 mono audio windows at EXPECTED_SR, newest audio only.
+    """
+    total_samples = int(duration_seconds * EXPECTED_SR)
+    max_new_tokens = int(window_seconds * FRAME_RATE)
+    context_samples = int(context_seconds * EXPECTED_SR)
+    produced = 0
+    window_index = 0
+    tail = None
+    breaker = BREAKERS["music"]
+
+    while produced < total_samples:
+        if cancelled():
+            logging.info(f"Music stream cancelled at {produced / EXPECTED_SR:.1f}s.")
+            metrics.increment("music.generations_cancelled")
+            return
+        if deadline is not None and deadline.expired():
+            logging.warning(f"Request deadline reached, music stopped at {produced / EXPECTED_SR:.1f}s.")
+            return
+        if not breaker.allow():
+            logging.warning("Music circuit is open, stopping music stream.")
+            return
+
+        window_index += 1
+        with music_model.use() as model, torch.no_grad(), \
+                torch_operator_profile(f"{label}_window{window_index}"):
+            inputs = conditioning_inputs(model, prompt_text)
+            if tail is not None:
+                inputs.update(processor(audio=tail, sampling_rate=EXPECTED_SR, return_tensors="pt"))
+            try:
+                audio_values = model.generate(
+                    **inputs,
+                    do_sample=True,
+                    guidance_scale=GUIDANCE_SCALE,
+                    max_new_tokens=max_new_tokens,
+                    max_time=deadline.remaining() if deadline is not None else None,
+                    stopping_criteria=stop_if_cancelled()
+                )
+            except Exception:
+                # Stopping mid-window can leave codes MusicGen cannot decode; not a model failure
+                if not cancelled():
+                    breaker.record_failure()
+                    raise
+        if cancelled():
+            continue  # Partial window; the check at the top of the loop ends the stream
+        breaker.record_success()
+
+        audio = audio_values[0, 0].cpu().numpy().astype(np.float32)
+
+        # The output starts with the audio prompt; keep only the continuation
+        if tail is not None:
+            audio = audio[len(tail):]
+        if len(audio) == 0:
+            logging.error("MusicGen returned no new audio, stopping music stream.")
+            return
+
+        window = audio[:total_samples - produced]
+        produced += len(window)
+
+        if np.max(np.abs(window)) <= MIN_AMPLITUDE:
+            logging.warning(f"Quiet music window ({produced / EXPECTED_SR:.1f}s / {duration_seconds:.1f}s).")
+
+        tail = audio[-context_samples:] if context_samples else None
+        yield window
+
+def generate_underlay_music(setting_key, setting_description, durations, deadline=None):
+    """
+    Prepares one long-form music stream per narration section.
+
+    Parameters:
+        setting_key (str): The selected story setting.
+        setting_description (str): A description of the setting.
+        durations (dict): Narration length in seconds for "beginning", "middle" and "ending".
+        deadline (Deadline, optional): Request budget shared with the other pipeline stages.
+
+    Returns:
+        dict: Section name -> generator of music windows (see `stream_music`).
+    """
+    logging.info(f"Preparing underlay music for {setting_key} ({setting_description})")
+
+    streams = {}
+    for section, prompt_key in UNDERLAY_SECTIONS.items():
+        prompt_text = format_music_prompt(prompt_key, setting_key, setting_description)
+        streams[section] = stream_music(prompt_text, durations[section], deadline=deadline, label=section)
+
+    return streams
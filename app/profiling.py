@@ -0,0 +1,238 @@
+import os
+import io
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+import metrics
+from config import PROFILE_SAMPLE_RATE, PROFILES_DIR
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# Number of hotspots listed per stage in the summary
+TOP_HOTSPOTS = 15
+
+# Profile of the request being handled in the current task / executor call (None if not sampled)
+current_profile = ContextVar("current_profile", default=None)
+current_stage = ContextVar("current_stage", default="unknown")
+
+# The torch profiler is process-global: only one block can be recorded at a time
+torch_profiler_lock = threading.Lock()
+
+# --------------------------------------------------------
+# REQUEST IDS
+# --------------------------------------------------------
+
+def new_request_id():
+    """
+    Returns a unique id for one pipeline request (timestamp + random suffix).
+
+    Used in every output file name, so concurrent sessions never overwrite each
+    other's files, and as the name of the request's profile folder.
+    """
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return f"{timestamp}_{uuid.uuid4().hex[:8]}"
+
+# --------------------------------------------------------
+# PER-REQUEST PROFILE
+# --------------------------------------------------------
+
+class RequestProfile:
+    """
+    Collects the profile of one sampled `full_pipeline` run.
+
+    - Wall-clock time per stage (story, narration, music, combine).
+    - A cProfile of every CPU-bound call the stage runs on the CPU executor
+      (validation, MusicGen, resampling, WAV writes), merged per stage.
+    - Extra files such as torch operator profiles written by the stages themselves.
+
+    Everything is written to PROFILES_DIR/<request_id>/ by `save()`.
+    """
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or new_request_id()
+        self.folder = os.path.join(PROFILES_DIR, self.request_id)
+        self.stage_seconds = {}
+        self.stats = {}
+        self.files = []
+        self.artifacts = []
+        self._lock = threading.Lock()
+
+    def add_stats(self, stage, profiler):
+        """Merges the statistics of a finished cProfile.Profile into `stage`."""
+        with self._lock:
+            if stage in self.stats:
+                self.stats[stage].add(profiler)
+            else:
+                self.stats[stage] = pstats.Stats(profiler)
+
+    def add_file(self, name):
+        """Registers an extra file in the profile folder and returns its path."""
+        os.makedirs(self.folder, exist_ok=True)
+        path = os.path.join(self.folder, name)
+        with self._lock:
+            self.files.append(path)
+        return path
+
+    def write_file(self, name, content):
+        """Writes an extra text file into the profile folder and returns its path."""
+        path = self.add_file(name)
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content)
+        return path
+
+    def hotspots(self, stage):
+        """Returns the top functions of a stage by own (total) time."""
+        stats = self.stats[stage]
+        rows = []
+        for (filename, line, function), (_, ncalls, tottime, cumtime, _) in stats.stats.items():
+            rows.append({
+                "function": f"{os.path.basename(filename)}:{line}({function})",
+                "calls": ncalls,
+                "own_seconds": round(tottime, 4),
+                "cumulative_seconds": round(cumtime, 4),
+            })
+        rows.sort(key=lambda row: row["own_seconds"], reverse=True)
+        return rows[:TOP_HOTSPOTS]
+
+    def save(self):
+        """
+        Writes the per-stage cProfile dumps and a summary of the top hotspots per stage.
+
+        Returns:
+            str: Path to the summary JSON file.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+
+        for stage, stats in self.stats.items():
+            stats.dump_stats(os.path.join(self.folder, f"{stage}.prof"))
+
+            report = io.StringIO()
+            stats.stream = report
+            stats.sort_stats("tottime").print_stats(TOP_HOTSPOTS)
+            self.write_file(f"{stage}_hotspots.txt", report.getvalue())
+
+        summary = {
+            "request_id": self.request_id,
+            "stage_seconds": {stage: round(seconds, 3) for stage, seconds in self.stage_seconds.items()},
+            "hotspots": {stage: self.hotspots(stage) for stage in self.stats},
+            "artifacts": self.artifacts,
+            "files": self.files,
+        }
+        summary_path = os.path.join(self.folder, "summary.json")
+        with open(summary_path, "w", encoding="utf-8") as file:
+            json.dump(summary, file, indent=2)
+
+        logging.info(f"Request profile saved at: {summary_path}")
+        return summary_path
+
+# --------------------------------------------------------
+# PROFILING HELPERS USED BY THE PIPELINE
+# --------------------------------------------------------
+
+def start_request_profile(sample_rate=PROFILE_SAMPLE_RATE, request_id=None):
+    """
+    Decides whether the current request is profiled and, if so, activates a RequestProfile
+    (named after `request_id` when given).
+
+    Returns:
+        RequestProfile or None: The active profile, or None if the request was not sampled.
+    """
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return None
+
+    profile = RequestProfile(request_id)
+    current_profile.set(profile)
+    metrics.increment("profiling.requests_profiled")
+    logging.info(f"Profiling request {profile.request_id}.")
+    return profile
+
+@contextmanager
+def stage(name):
+    """
+    Marks a pipeline stage: records its wall time (always, as `pipeline.<name>_seconds`)
+    and attributes CPU executor calls made inside it to `name` in the request profile.
+    """
+    token = current_stage.set(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        current_stage.reset(token)
+        metrics.observe(f"pipeline.{name}_seconds", elapsed)
+        profile = current_profile.get()
+        if profile is not None:
+            profile.stage_seconds[name] = profile.stage_seconds.get(name, 0.0) + elapsed
+
+def profile_call(func, *args, **kwargs):
+    """
+    Calls `func` under cProfile when the current request is being profiled.
+
+    Python allows only one active profiler at a time on some versions; if another
+    profile is already running the call simply runs unprofiled.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        logging.debug("Another profiler is active, running call without profiling.")
+        return func(*args, **kwargs)
+
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profile.add_stats(current_stage.get(), profiler)
+
+@contextmanager
+def torch_operator_profile(name):
+    """
+    Records a torch operator profile of the block when the current request is being profiled.
+
+    Writes `torch_<name>.txt` (top operators by self CPU time) and a Chrome trace
+    `torch_<name>.json` into the request's profile folder.
+
+    If another block is already being recorded the block simply runs unprofiled.
+    """
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+
+    if not torch_profiler_lock.acquire(blocking=False):
+        logging.debug(f"Torch profiler is busy, running {name} without operator profiling.")
+        yield
+        return
+
+    from torch.profiler import profile as torch_profile, ProfilerActivity
+
+    try:
+        with torch_profile(activities=[ProfilerActivity.CPU]) as prof:
+            yield
+    finally:
+        torch_profiler_lock.release()
+
+    profile.write_file(
+        f"torch_{name}.txt",
+        prof.key_averages().table(sort_by="self_cpu_time_total", row_limit=TOP_HOTSPOTS)
+    )
+    prof.export_chrome_trace(profile.add_file(f"torch_{name}.json"))
@@ -0,0 +1,142 @@
+import os
+import re
+import glob
+import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pyphen import Pyphen
+from config import STORIES_DIR
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# SINGLE-PASS READABILITY SCORING
+# --------------------------------------------------------
+# Mirrors textstat's English Flesch Reading Ease and Flesch-Kincaid Grade:
+# - words: punctuation removed (apostrophes of contractions kept), split on whitespace
+# - sentences: regex split, sentences of two words or fewer are ignored (minimum 1)
+# - syllables: CMU Pronouncing Dictionary, falling back to Pyphen hyphenation
+# but tokenizes the text once and counts each distinct word's syllables only once.
+
+ReadabilityScores = namedtuple("ReadabilityScores", ["flesch_reading_ease", "flesch_kincaid_grade", "word_count"])
+
+SENTENCE_PATTERN = re.compile(r"\b[^.!?]+[.!?]*", re.UNICODE)
+NONCONTRACTION_APOSTROPHE = re.compile(r"\'(?![tsd]|ve|ll|re)")
+PUNCTUATION = re.compile(r"[^\w\s\']")
+
+_pyphen = Pyphen(lang="en_US")
+_cmudict = None
+
+def load_cmudict():
+    """
+    Loads the CMU Pronouncing Dictionary through nltk (the same source textstat uses).
+
+    Returns:
+        dict or None: word -> list of pronunciations, or None if it is unavailable
+        (syllables are then counted with Pyphen only).
+    """
+    global _cmudict
+    if _cmudict is None:
+        try:
+            import nltk
+            try:
+                nltk.data.find("corpora/cmudict")
+            except LookupError:
+                nltk.download("cmudict", quiet=True)
+            _cmudict = nltk.corpus.cmudict.dict()
+        except (ImportError, LookupError, OSError) as e:
+            logging.warning(f"CMU dictionary unavailable, counting syllables with Pyphen only: {e}")
+            _cmudict = {}
+    return _cmudict or None
+
+@lru_cache(maxsize=100_000)
+def count_word_syllables(word):
+    """Returns the syllable count of one lowercase word (cached per word)."""
+    cmudict = load_cmudict()
+    if cmudict:
+        pronunciations = cmudict.get(word)
+        if pronunciations:
+            return sum(1 for phone in pronunciations[0] if phone[-1].isdigit())
+    return len(_pyphen.positions(word)) + 1
+
+def list_words(text):
+    """Splits text into words after removing punctuation (keeping contraction apostrophes)."""
+    text = NONCONTRACTION_APOSTROPHE.sub("", text)
+    return PUNCTUATION.sub("", text).split()
+
+def score_text(text):
+    """
+    Computes Flesch Reading Ease, Flesch-Kincaid Grade and word count in one pass.
+
+    Parameters:
+        text (str): The story text.
+
+    Returns:
+        ReadabilityScores: (flesch_reading_ease, flesch_kincaid_grade, word_count), where
+        word_count is the whitespace token count used by `validate_story`.
+    """
+    word_count = len(text.split())
+    words = list_words(text)
+    if not words:
+        return ReadabilityScores(0.0, 0.0, word_count)
+
+    sentences = SENTENCE_PATTERN.findall(text)
+    ignored = sum(1 for sentence in sentences if len(list_words(sentence)) <= 2)
+    sentence_count = max(1, len(sentences) - ignored)
+
+    syllables = sum(count_word_syllables(word.lower()) for word in words)
+    if syllables == 0:
+        return ReadabilityScores(0.0, 0.0, word_count)
+
+    words_per_sentence = len(words) / sentence_count
+    syllables_per_word = syllables / len(words)
+
+    flesch_reading_ease = 206.835 - 1.015 * words_per_sentence - 84.6 * syllables_per_word
+    flesch_kincaid_grade = 0.39 * words_per_sentence + 11.8 * syllables_per_word - 15.59
+
+    return ReadabilityScores(flesch_reading_ease, flesch_kincaid_grade, word_count)
+
+# --------------------------------------------------------
+# BATCH SCORING
+# --------------------------------------------------------
+
+def score_texts(texts, max_workers=None, chunksize=32):
+    """
+    Scores many texts in parallel with a process pool.
+
+    Parameters:
+        texts (list): Texts to score.
+        max_workers (int, optional): Number of worker processes (defaults to the CPU count).
+        chunksize (int): Texts sent to a worker per task; larger chunks reuse each
+            worker's syllable cache better.
+
+    Returns:
+        list: ReadabilityScores in the same order as `texts`.
+    """
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=load_cmudict) as executor:
+        return list(executor.map(score_text, texts, chunksize=chunksize))
+
+def read_text(path):
+    """Reads a UTF-8 text file."""
+    with open(path, "r", encoding="utf-8") as file:
+        return file.read()
+
+def score_story_files(folder=STORIES_DIR, pattern="story_*_full.txt", max_workers=None):
+    """
+    Scores every stored full story in `folder`.
+
+    Returns:
+        dict: File path -> ReadabilityScores.
+    """
+    paths = sorted(glob.glob(os.path.join(folder, pattern)))
+    logging.info(f"Scoring {len(paths)} stored stories from {folder}...")
+    texts = [read_text(path) for path in paths]
+    return dict(zip(paths, score_texts(texts, max_workers=max_workers)))
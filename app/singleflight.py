@@ -0,0 +1,87 @@
+import asyncio
+import logging
+import metrics
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# SINGLE-FLIGHT REQUEST COALESCING
+# --------------------------------------------------------
+
+class Flight:
+    """One in-flight computation and the number of callers awaiting it."""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that would compute the same result.
+
+    The first caller for a key starts the work; callers arriving while it is still
+    running await the same task and receive the same result (or exception). Once the
+    work finishes the key is forgotten, so later calls compute a fresh result.
+
+    One caller being cancelled does not affect the others, but when every caller
+    has been cancelled the shared work is cancelled too, since nobody needs it.
+
+    Metrics:
+        singleflight.<name>.executed      Computations actually started.
+        singleflight.<name>.deduplicated  Calls served by an in-flight computation.
+        singleflight.<name>.cancelled     Computations cancelled because all callers left.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {}
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Runs `await func(*args, **kwargs)` once per key among concurrent callers.
+
+        Parameters:
+            key (hashable): Identifies identical work.
+            func (coroutine function): Produces the result.
+
+        Returns:
+            The result of the shared computation.
+        """
+        # Tasks belong to one event loop, so flights are tracked per loop
+        flight_key = (id(asyncio.get_running_loop()), key)
+        flight = self._flights.get(flight_key)
+
+        if flight is None:
+            flight = Flight(asyncio.ensure_future(func(*args, **kwargs)))
+            self._flights[flight_key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(flight_key, flight))
+            metrics.increment(f"singleflight.{self.name}.executed")
+        else:
+            logging.info(f"Joining in-flight {self.name} computation.")
+            metrics.increment(f"singleflight.{self.name}.deduplicated")
+
+        flight.waiters += 1
+        try:
+            # Shield the shared task so one caller giving up does not cancel it for the others
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                logging.info(f"All callers left, cancelling {self.name} computation.")
+                metrics.increment(f"singleflight.{self.name}.cancelled")
+                # Later callers must start fresh rather than join a cancelled task
+                self._forget(flight_key, flight)
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+
+    def _forget(self, flight_key, flight):
+        if self._flights.get(flight_key) is flight:
+            del self._flights[flight_key]
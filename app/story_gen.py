@@ -1,11 +1,21 @@
 import os
-import subprocess
+import math
+import asyncio
 import logging
 import json
-from datetime import datetime
-from textstat import textstat
+import time
+import httpx
 import re
-from config import METADATA_PATH, PROMPT_DIR, PROHIBITED_WORDS, STORIES_DIR
+import metrics
+from readability import score_text
+from workers import run_cpu
+from profiling import new_request_id
+from deadline import BREAKERS, backend_call_timeout
+from config import (
+    METADATA_PATH, PROMPT_DIR, PROHIBITED_WORDS, STORIES_DIR,
+    STORY_MAX_ATTEMPTS, STORY_MAX_PARALLEL_CANDIDATES, STORY_TARGET_SUCCESS_RATE, STORY_GENERATION_MODE,
+    LLM_BACKEND, LLM_MODEL, OLLAMA_URL, LLM_CALL_TIMEOUT_SECONDS,
+)
 
 # --------------------------------------------------------
 # LOGGING CONFIGURATION
@@ -34,6 +44,16 @@ def load_prompt(file_path):
 beginning_prompt_template = load_prompt(os.path.join(PROMPT_DIR, "story_beginning.txt"))
 middle_prompt_template = load_prompt(os.path.join(PROMPT_DIR, "story_middle.txt"))
 ending_prompt_template = load_prompt(os.path.join(PROMPT_DIR, "story_ending.txt"))
+full_prompt_template = load_prompt(os.path.join(PROMPT_DIR, "story_full.txt"))
+
+# Section delimiters the model is asked to use in single-call mode
+SECTION_MARKERS = {
+    "beginning": "### BEGINNING ###",
+    "middle": "### MIDDLE ###",
+    "ending": "### ENDING ###",
+}
+# Closes the ending; anything the model adds after it is not part of the story
+END_MARKER = "### THE END ###"
 
 # --------------------------------------------------------
 # STORY VALIDATION FUNCTION
@@ -43,6 +63,7 @@ def validate_story(text):
     """
     Validates a generated story based on readability, word count, and prohibited words.
     
+    - Scores readability and word count in a single pass (see `readability.score_text`).
     - Uses Flesch Reading Ease to ensure readability is child-friendly.
     - Uses Flesch-Kincaid Grade Level to keep the complexity suitable for young readers.
     - Ensures the word count falls within a reasonable range (800–1300 words).
@@ -53,9 +74,7 @@ def validate_story(text):
     """
 
     # Readability metrics
-    flesch_reading_ease = textstat.flesch_reading_ease(text)
-    flesch_kincaid_grade = textstat.flesch_kincaid_grade(text)
-    word_count = len(text.split())
+    flesch_reading_ease, flesch_kincaid_grade, word_count = score_text(text)
 
     # Check for prohibited words
     flagged_terms = [word for word in PROHIBITED_WORDS if re.search(word, text, re.IGNORECASE)]
@@ -84,60 +103,340 @@ def validate_story(text):
 # STORY GENERATION FUNCTION (LLM INTERACTION)
 # --------------------------------------------------------
 
-def generate_story_section(prompt, model_name="llama3.1"):
+async def run_ollama_cli(prompt, model_name, timeout=None):
+    """
+    Runs `ollama run` as an asyncio subprocess and returns its output.
+
+    The process is killed if the calling task is cancelled or `timeout` expires, so
+    abandoned candidates stop using the LLM backend right away.
+    """
+    process = await asyncio.create_subprocess_exec(
+        "ollama", "run", model_name,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(input=prompt.encode("utf-8")), timeout)
+    except (asyncio.CancelledError, asyncio.TimeoutError):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise RuntimeError(f"ollama exited with code {process.returncode}: {stderr.decode('utf-8', 'replace')}")
+
+    return stdout.decode("utf-8")
+
+async def run_ollama_http(prompt, model_name, timeout=None):
+    """Sends the prompt to the Ollama HTTP API and returns the generated text."""
+    async with httpx.AsyncClient(timeout=timeout) as client:
+        response = await client.post(OLLAMA_URL, json={"model": model_name, "prompt": prompt, "stream": False})
+        response.raise_for_status()
+        return response.json().get("response", "")
+
+async def generate_story_section_async(prompt, model_name=LLM_MODEL, deadline=None):
     """
     Sends a text prompt to a language model and retrieves a generated response.
 
+    - Uses the `ollama run` CLI or the Ollama HTTP API depending on LLM_BACKEND.
+    - Does not block the event loop while waiting for the model.
+    - Fails fast (empty response) when the request deadline is spent or the LLM circuit is open.
+
     Parameters:
         prompt (str): The input text prompt for the model.
         model_name (str): The name of the AI model used for generation.
+        deadline (Deadline, optional): Request budget; its remaining time bounds the call.
 
     Returns:
         str: The generated text from the model.
     """
+    breaker = BREAKERS["llm"]
+    if deadline is not None and deadline.expired():
+        logging.warning("Request deadline reached, skipping model call.")
+        return ""
+    if not breaker.allow():
+        logging.warning("LLM circuit is open, skipping model call.")
+        return ""
+
+    logging.info(f"Sending prompt to model ({model_name})...")
+    start = time.perf_counter()
+    timeout, timeout_is_failure = backend_call_timeout(deadline, LLM_CALL_TIMEOUT_SECONDS)
+
     try:
-        logging.info(f"Sending prompt to model ({model_name})...")
-
-        # Run the LLM model as a subprocess
-        process = subprocess.run(
-            ["ollama", "run", model_name],
-            input=prompt,
-            text=True,
-            capture_output=True,
-            check=True,
-            encoding="utf-8"
-        )
-
-        response = process.stdout.strip()
-
-        if response:
-            logging.info("Story section successfully generated.")
+        if LLM_BACKEND == "http":
+            response = await run_ollama_http(prompt, model_name, timeout)
+        else:
+            response = await run_ollama_cli(prompt, model_name, timeout)
+    except asyncio.CancelledError:
+        metrics.increment("story.llm_calls_cancelled")
+        metrics.observe("story.llm_call_seconds", time.perf_counter() - start)
+        logging.info("Story section cancelled.")
+        raise
+    except (asyncio.TimeoutError, httpx.TimeoutException):
+        metrics.increment("story.llm_timeouts")
+        if timeout_is_failure:
+            breaker.record_failure()
+            logging.error(f"Model call timed out after {timeout:.0f}s.")
         else:
-            logging.warning("Model returned an empty response. Retrying...")
+            logging.error("Model call timed out at the request deadline.")
+        return ""
+    except (RuntimeError, OSError, httpx.HTTPError) as e:
+        breaker.record_failure()
+        logging.error(f"Model execution failed: {e}")
+        return ""
 
-        return response or ""
+    breaker.record_success()
+    metrics.increment("story.llm_calls")
+    metrics.observe("story.llm_call_seconds", time.perf_counter() - start)
 
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Model execution failed: {e.stderr}")
-        return ""
+    response = response.strip()
+
+    if response:
+        logging.info("Story section successfully generated.")
+    else:
+        logging.warning("Model returned an empty response. Retrying...")
+
+    return response
+
+def generate_story_section(prompt, model_name=LLM_MODEL):
+    """Blocking wrapper around `generate_story_section_async` for scripts and benchmarks."""
+    return asyncio.run(generate_story_section_async(prompt, model_name))
+
+async def generate_story_sections(setting_key, selected_characters, theme_key, setting_description,
+                                  theme_description, character_descriptions, deadline=None):
+    """
+    Generates a story with three sequential LLM calls (beginning, middle, ending).
+
+    Returns:
+        tuple: (beginning, middle, ending) texts.
+    """
+    # ---- GENERATE BEGINNING ----
+    beginning_prompt = beginning_prompt_template.format(
+        setting=setting_key,
+        setting_description=setting_description,
+        characters=", ".join(selected_characters),
+        theme_key=theme_key,
+        theme_description=theme_description,
+        character_descriptions=character_descriptions
+    )
+    beginning_response = await generate_story_section_async(beginning_prompt, deadline=deadline)
+
+    # ---- GENERATE MIDDLE ----
+    middle_prompt = middle_prompt_template.format(
+        beginning=beginning_response,
+        theme=theme_key
+    )
+    middle_response = await generate_story_section_async(middle_prompt, deadline=deadline)
+
+    # ---- GENERATE ENDING ----
+    ending_prompt = ending_prompt_template.format(
+        beginning=beginning_response,
+        middle=middle_response,
+        theme=theme_key
+    )
+    end_response = await generate_story_section_async(ending_prompt, deadline=deadline)
+
+    return beginning_response, middle_response, end_response
+
+def parse_full_story(response):
+    """
+    Splits a single-call model response into its beginning, middle and ending.
+
+    - Accepts the markers from SECTION_MARKERS and END_MARKER on their own line, with
+      their `###` delimiters, ignoring case and any markdown emphasis the model adds
+      around them (e.g. `**### BEGINNING ###**`). A story line that merely reads
+      "Middle" is not a marker.
+    - The ending stops at END_MARKER, so closing remarks the model adds after the story
+      are never narrated.
+    - Fails if a marker is missing, repeated, out of order, or followed by an empty section.
+
+    Parameters:
+        response (str): The raw model response.
+
+    Returns:
+        tuple or None: (beginning, middle, ending) texts, or None if the response cannot be parsed.
+    """
+    positions = []
+    for marker in list(SECTION_MARKERS.values()) + [END_MARKER]:
+        name = r"\s+".join(re.escape(word) for word in marker.strip("# ").split())
+        pattern = r"^[ \t*_]*###[ \t]*" + name + r"[ \t]*###[ \t*_:]*$"
+        matches = list(re.finditer(pattern, response, re.IGNORECASE | re.MULTILINE))
+        if len(matches) != 1:
+            return None
+        positions.append((matches[0].start(), matches[0].end()))
+
+    if positions != sorted(positions):
+        return None
+
+    sections = []
+    for (_, content_start), (content_end, _) in zip(positions, positions[1:]):
+        section = response[content_start:content_end].strip()
+        if not section:
+            return None
+        sections.append(section)
+
+    return tuple(sections)
+
+async def generate_story_single_call(setting_key, selected_characters, theme_key, setting_description,
+                                     theme_description, character_descriptions, deadline=None):
+    """
+    Generates the whole story with one LLM call and splits it into sections.
+
+    Returns:
+        tuple or None: (beginning, middle, ending) texts, or None if the response could not be parsed.
+    """
+    full_prompt = full_prompt_template.format(
+        setting=setting_key,
+        setting_description=setting_description,
+        characters=", ".join(selected_characters),
+        theme_key=theme_key,
+        theme_description=theme_description,
+        character_descriptions=character_descriptions,
+        beginning_marker=SECTION_MARKERS["beginning"],
+        middle_marker=SECTION_MARKERS["middle"],
+        ending_marker=SECTION_MARKERS["ending"],
+        end_marker=END_MARKER
+    )
+    response = await generate_story_section_async(full_prompt, deadline=deadline)
+    return parse_full_story(response)
+
+async def generate_story_candidate(setting_key, selected_characters, theme_key, setting_description,
+                                   theme_description, character_descriptions, mode=STORY_GENERATION_MODE,
+                                   deadline=None):
+    """
+    Generates one complete story candidate (beginning, middle and ending).
+
+    - "sections" mode uses three sequential LLM calls.
+    - "single_call" mode asks for the whole story at once and falls back to the
+      three-call path if the response cannot be split into sections.
+
+    Returns:
+        tuple: (beginning, middle, ending) texts.
+    """
+    args = (setting_key, selected_characters, theme_key, setting_description,
+            theme_description, character_descriptions, deadline)
+    start = time.perf_counter()
+
+    if mode == "single_call":
+        sections = await generate_story_single_call(*args)
+        if sections:
+            metrics.observe("story.candidate_seconds", time.perf_counter() - start)
+            return sections
+        metrics.increment("story.single_call_parse_failures")
+        logging.warning("Could not split single-call story into sections. Falling back to three calls...")
+
+    sections = await generate_story_sections(*args)
+    metrics.observe("story.candidate_seconds", time.perf_counter() - start)
+    return sections
+
+# --------------------------------------------------------
+# ADAPTIVE CANDIDATE COUNT
+# --------------------------------------------------------
+
+def choose_candidate_count(max_candidates, remaining_attempts):
+    """
+    Picks how many story candidates to keep in flight.
+
+    - Estimates the validation pass rate from previous candidates (Laplace-smoothed).
+    - Chooses the smallest K for which at least one of K candidates passes with
+      probability STORY_TARGET_SUCCESS_RATE.
+    - Caps K by the number of idle CPU cores so a busy host falls back towards serial retries.
+
+    Parameters:
+        max_candidates (int): Upper bound on parallel candidates.
+        remaining_attempts (int): Candidates still allowed for this request.
+
+    Returns:
+        int: Number of candidates to run concurrently (at least 1).
+    """
+    limit = max(1, min(max_candidates, remaining_attempts))
+    if limit == 1:
+        return 1
+
+    passed = metrics.get_counter("story.candidates_passed")
+    validated = metrics.get_counter("story.candidates_validated")
+    pass_rate = (passed + 1) / (validated + 2)
+
+    if pass_rate >= STORY_TARGET_SUCCESS_RATE:
+        wanted = 1
+    else:
+        wanted = math.ceil(math.log(1 - STORY_TARGET_SUCCESS_RATE) / math.log(1 - pass_rate))
+
+    try:
+        idle_cores = (os.cpu_count() or 1) - os.getloadavg()[0]
+        wanted = min(wanted, max(1, int(idle_cores)))
+    except (AttributeError, OSError):
+        pass  # Load average is unavailable on this platform
+
+    return max(1, min(wanted, limit))
 
 # --------------------------------------------------------
 # FULL STORY GENERATION FUNCTION
 # --------------------------------------------------------
 
-def generate_story(setting_key, selected_characters, theme_key):
+def save_story(beginning_response, middle_response, end_response, full_story, request_id=None):
+    """
+    Saves the story sections and the full story to STORIES_DIR.
+
+    Parameters:
+        request_id (str, optional): Pipeline request id used in the file names
+            (a new unique id when omitted).
+
+    Returns:
+        dict: File paths for the full story and each section.
+    """
+    request_id = request_id or new_request_id()
+    story_folder = STORIES_DIR
+    os.makedirs(story_folder, exist_ok=True)
+
+    # Save story parts separately
+    beginning_path = os.path.join(story_folder, f"story_{request_id}_beginning.txt")
+    middle_path = os.path.join(story_folder, f"story_{request_id}_middle.txt")
+    ending_path = os.path.join(story_folder, f"story_{request_id}_end.txt")
+    full_story_path = os.path.join(story_folder, f"story_{request_id}_full.txt")
+
+    # Write each section to its respective file
+    for path, content in zip(
+        [beginning_path, middle_path, ending_path, full_story_path],
+        [beginning_response, middle_response, end_response, full_story]
+    ):
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(content)
+
+    logging.debug(f"Story parts saved at:\n- {beginning_path}\n- {middle_path}\n- {ending_path}\n- {full_story_path}")
+
+    return {
+        "full_story": full_story_path,
+        "beginning": beginning_path,
+        "middle": middle_path,
+        "ending": ending_path
+    }
+
+async def generate_story_async(setting_key, selected_characters, theme_key, max_parallel_candidates=None,
+                               mode=None, deadline=None, request_id=None):
     """
     Generates a children's story in three sections (beginning, middle, and end).
     
     - Utilizes metadata to structure the story.
-    - Calls the LLM model to generate each section.
-    - Runs validation to ensure quality.
+    - Calls the LLM model to generate each section without blocking the event loop.
+    - Runs validation (on the CPU executor) to ensure quality.
     - Saves the story parts only if validation passes.
+    - With more than one parallel candidate, races several stories against the LLM backend;
+      the first one that passes validation wins and the others are cancelled.
+    - Stops starting new candidates when a typical candidate no longer fits in the
+      request deadline or the LLM circuit is open.
 
     Parameters:
         setting_key (str): The selected story setting.
         selected_characters (list): List of chosen characters.
         theme_key (str): The selected theme.
+        max_parallel_candidates (int, optional): Upper bound on concurrent candidates.
+            Defaults to STORY_MAX_PARALLEL_CANDIDATES.
+        mode (str, optional): "sections" or "single_call". Defaults to STORY_GENERATION_MODE.
+        deadline (Deadline, optional): Request budget shared with the other pipeline stages.
+        request_id (str, optional): Pipeline request id used in the story file names.
 
     Returns:
         tuple: The full story text and a dictionary of file paths for each section.
@@ -155,76 +454,74 @@ def generate_story(setting_key, selected_characters, theme_key):
         [f"{char}: {metadata['characters'][char]['description']}" for char in selected_characters]
     )
 
-    MAX_ATTEMPTS = 5  # Maximum attempts for generating a valid story
-    is_valid = False
-    attempt = 1
-
-    while not is_valid and attempt <= MAX_ATTEMPTS:
-        logging.info(f"Generating story attempt {attempt}...")
-
-        # ---- GENERATE BEGINNING ----
-        beginning_prompt = beginning_prompt_template.format(
-            setting=setting_key,
-            setting_description=setting_description,
-            characters=", ".join(selected_characters),
-            theme_key=theme_key,
-            theme_description=theme_description,
-            character_descriptions=character_descriptions
-        )
-        beginning_response = generate_story_section(beginning_prompt)
-
-        # ---- GENERATE MIDDLE ----
-        middle_prompt = middle_prompt_template.format(
-            beginning=beginning_response,
-            theme=theme_key
-        )
-        middle_response = generate_story_section(middle_prompt)
-
-        # ---- GENERATE ENDING ----
-        ending_prompt = ending_prompt_template.format(
-            beginning=beginning_response,
-            middle=middle_response,
-            theme=theme_key
-        )
-        end_response = generate_story_section(ending_prompt)
-
-        # Combine the full story
-        full_story = f"{beginning_response}\n\n{middle_response}\n\n{end_response}"
-
-        # ---- VALIDATE STORY ----
-        is_valid = validate_story(full_story)
-
-        if not is_valid:
-            logging.warning("Story validation failed. Regenerating...")
-            attempt += 1
-            continue  # Skip saving and retry story generation
-
-        # ---- SAVE STORY FILES ----
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        story_folder = STORIES_DIR
-        os.makedirs(story_folder, exist_ok=True)
-
-        # Save story parts separately
-        beginning_path = os.path.join(story_folder, f"story_{timestamp}_beginning.txt")
-        middle_path = os.path.join(story_folder, f"story_{timestamp}_middle.txt")
-        ending_path = os.path.join(story_folder, f"story_{timestamp}_end.txt")
-        full_story_path = os.path.join(story_folder, f"story_{timestamp}_full.txt")
-
-        # Write each section to its respective file
-        for path, content in zip(
-            [beginning_path, middle_path, ending_path, full_story_path], 
-            [beginning_response, middle_response, end_response, full_story]
-        ):
-            with open(path, "w", encoding="utf-8") as file:
-                file.write(content)
-
-        logging.debug(f"Story parts saved at:\n- {beginning_path}\n- {middle_path}\n- {ending_path}\n- {full_story_path}")
-
-        return full_story, {
-            "full_story": full_story_path,
-            "beginning": beginning_path,
-            "middle": middle_path,
-            "ending": ending_path
-        }
+    if max_parallel_candidates is None:
+        max_parallel_candidates = STORY_MAX_PARALLEL_CANDIDATES
+    if mode is None:
+        mode = STORY_GENERATION_MODE
 
+    start = time.perf_counter()
+    candidate_args = (setting_key, selected_characters, theme_key, setting_description,
+                      theme_description, character_descriptions, mode, deadline)
+
+    launched = 0
+    in_flight = set()
+
+    try:
+        while launched < STORY_MAX_ATTEMPTS or in_flight:
+            # Top up the in-flight candidates to the adaptive target
+            target = choose_candidate_count(max_parallel_candidates, STORY_MAX_ATTEMPTS - launched + len(in_flight))
+            while len(in_flight) < target and launched < STORY_MAX_ATTEMPTS:
+                if not BREAKERS["llm"].allow() or (
+                    deadline is not None and not deadline.can_afford("story.candidate_seconds")
+                ):
+                    launched = STORY_MAX_ATTEMPTS  # Out of budget: let in-flight candidates finish
+                    break
+                launched += 1
+                logging.info(f"Generating story attempt {launched} ({len(in_flight) + 1} in flight)...")
+                in_flight.add(asyncio.create_task(generate_story_candidate(*candidate_args)))
+                metrics.increment("story.candidates_started")
+
+            if not in_flight:
+                break
+
+            done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                beginning_response, middle_response, end_response = task.result()
+
+                # Combine the full story
+                full_story = f"{beginning_response}\n\n{middle_response}\n\n{end_response}"
+
+                # ---- VALIDATE STORY ----
+                is_valid = await run_cpu(validate_story, full_story)
+                metrics.increment("story.candidates_validated")
+
+                if not is_valid:
+                    logging.warning("Story validation failed. Regenerating...")
+                    continue  # Skip saving and retry story generation
+
+                metrics.increment("story.candidates_passed")
+
+                # ---- SAVE STORY FILES ----
+                story_paths = save_story(beginning_response, middle_response, end_response, full_story, request_id)
+                metrics.observe("story.latency_seconds", time.perf_counter() - start)
+
+                return full_story, story_paths
+
+    finally:
+        # First valid candidate wins (or the request was cancelled); stop the others
+        if in_flight:
+            logging.info(f"Cancelling {len(in_flight)} in-flight story candidate(s).")
+            metrics.increment("story.candidates_cancelled", len(in_flight))
+            for task in in_flight:
+                task.cancel()
+            await asyncio.gather(*in_flight, return_exceptions=True)
+
+    metrics.observe("story.latency_seconds", time.perf_counter() - start)
     return None, None  # Return None if no valid story is generated
+
+def generate_story(setting_key, selected_characters, theme_key, max_parallel_candidates=None, mode=None,
+                   deadline=None, request_id=None):
+    """Blocking wrapper around `generate_story_async` for scripts and benchmarks."""
+    return asyncio.run(generate_story_async(setting_key, selected_characters, theme_key,
+                                            max_parallel_candidates, mode, deadline, request_id))
@@ -1,11 +1,17 @@
 import os
-import requests
+import asyncio
+import hashlib
+import httpx
 import logging
 import librosa
 import time
 import numpy as np
-from datetime import datetime
-from config import NARRATIONS_DIR
+import metrics
+from workers import run_cpu
+from profiling import new_request_id
+from deadline import BREAKERS, remaining_or_none, backend_call_timeout
+from singleflight import SingleFlight
+from config import NARRATIONS_DIR, TTS_URL, TTS_CALL_TIMEOUT_SECONDS
 
 # --------------------------------------------------------
 # LOGGING CONFIGURATION
@@ -66,77 +72,144 @@ def validate_audio(file_path):
 # TEXT-TO-SPEECH (TTS) GENERATION FUNCTION
 # --------------------------------------------------------
 
-def generate_narration(text_files, output_folder=NARRATIONS_DIR):
+# Coalesces identical texts sent to the TTS service at the same time
+tts_flights = SingleFlight("tts")
+
+async def request_tts(text, deadline=None):
+    """
+    Sends one text to the TTS service, retrying on failure.
+
+    - Bounds each request by the remaining deadline and skips retries that no longer fit
+      in it; stops calling the TTS service while its circuit is open.
+
+    Parameters:
+        text (str): The text to convert.
+        deadline (Deadline, optional): Request budget shared with the other pipeline stages.
+
+    Returns:
+        bytes or None: The WAV audio returned by the service, or None if every attempt failed.
+    """
+    # Define TTS API request parameters
+    headers = {"Content-Type": "application/json"}
+    data = {"text": text}
+
+    # Attempt to request TTS conversion
+    MAX_TTS_ATTEMPTS = 3
+    breaker = BREAKERS["tts"]
+
+    async with httpx.AsyncClient(timeout=None) as client:
+        for attempt in range(MAX_TTS_ATTEMPTS):
+            if not breaker.allow():
+                logging.warning("TTS circuit is open, skipping request.")
+                return None
+            if deadline is not None and not deadline.can_afford("tts.request_seconds"):
+                logging.error("TTS request skipped, not enough time left before the deadline.")
+                return None
+
+            timeout, timeout_is_failure = backend_call_timeout(deadline, TTS_CALL_TIMEOUT_SECONDS)
+            try:
+                logging.info(f"TTS request attempt {attempt+1} / {MAX_TTS_ATTEMPTS}")
+                start = time.perf_counter()
+                response = await client.post(TTS_URL, headers=headers, json=data, timeout=timeout)
+                metrics.observe("tts.request_seconds", time.perf_counter() - start)
+
+                if response.status_code == 200:
+                    # Successful response
+                    breaker.record_success()
+                    return response.content
+                breaker.record_failure()
+            except httpx.TimeoutException:
+                if not timeout_is_failure:
+                    # The request ran out of budget; the service is not to blame
+                    logging.error("TTS request timed out at the request deadline.")
+                    return None
+                breaker.record_failure()
+                logging.warning(f"TTS request timed out after {timeout:.0f}s.")
+            except httpx.HTTPError:
+                breaker.record_failure()
+                # Log failure and retry after a short delay
+                if attempt < MAX_TTS_ATTEMPTS - 1:
+                    logging.warning("TTS request failed. Retrying...")
+                    await asyncio.sleep(2)
+
+    logging.error("TTS request failed after max attempts.")
+    return None
+
+async def generate_narration_async(text_files, output_folder=NARRATIONS_DIR, deadline=None, request_id=None):
     """
     Converts a list of text files into TTS-generated narration audio files.
     
-    - Sends text content to a local TTS service (MeloTTS) via an API request.
+    - Sends text content to a local TTS service (MeloTTS) via an async HTTP request.
+      Identical texts requested concurrently (e.g. by other sessions) share one request;
+      it is not bound by any caller's deadline, each caller stops waiting at its own.
     - Saves the generated audio files in the specified output folder.
-    - Validates each audio file before finalizing the output list.
+    - Validates each audio file (on the CPU executor) before finalizing the output list.
+    - If the request is cancelled, the narration files written so far are removed.
 
     Parameters:
         text_files (list): List of file paths containing the story text.
         output_folder (str): Directory to save the generated narration files.
+        deadline (Deadline, optional): Request budget shared with the other pipeline stages.
+        request_id (str, optional): Pipeline request id used in the file names
+            (a new unique id when omitted).
 
     Returns:
         list: A list of valid narration file paths.
     """
     
     logging.info("Starting TTS narration generation...")
+    request_id = request_id or new_request_id()
     narration_paths = []
+    written_paths = []
 
     try:
         # Ensure output directory exists
         os.makedirs(output_folder, exist_ok=True)
 
         for i, text_file in enumerate(text_files):
-            # Generate a unique timestamped filename for each narration part
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            output_file = os.path.join(output_folder, f"narration_part_{i+1}_{timestamp}.wav")
+            # Unique per request, so concurrent sessions never share a file
+            output_file = os.path.join(output_folder, f"narration_part_{i+1}_{request_id}.wav")
 
             # Read text from file
             with open(text_file, "r", encoding="utf-8") as file:
                 text = file.read()
             logging.debug(f"Processing TTS for: {text_file} (Length: {len(text)} chars)")
 
-            # Define TTS API request parameters
-            url = "http://localhost:8888/convert/tts"  # Local TTS API endpoint
-            headers = {"Content-Type": "application/json"}
-            data = {"text": text}
-
-            # Attempt to request TTS conversion
-            MAX_TTS_ATTEMPTS = 3
-            for attempt in range(MAX_TTS_ATTEMPTS):
-                try:
-                    logging.info(f"TTS request attempt {attempt+1} / {MAX_TTS_ATTEMPTS}")
-                    response = requests.post(url, headers=headers, json=data)
-
-                    if response.status_code == 200:
-                        # Successful response, exit retry loop
-                        break
-                except requests.exceptions.RequestException:
-                    # Log failure and retry after a short delay
-                    if attempt < MAX_TTS_ATTEMPTS - 1:
-                        logging.warning("TTS request failed. Retrying...")
-                        time.sleep(2)
-            else:
+            text_key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+            try:
+                audio = await asyncio.wait_for(tts_flights.do(text_key, request_tts, text),
+                                               remaining_or_none(deadline))
+            except asyncio.TimeoutError:
+                logging.error("Request deadline reached while waiting for TTS.")
+                audio = None
+            if audio is None:
                 # If all attempts fail, skip this text file
-                logging.error("TTS request failed after max attempts.")
                 continue
 
             # Save the TTS-generated audio file
             with open(output_file, "wb") as file:
-                file.write(response.content)
+                file.write(audio)
+            written_paths.append(output_file)
             logging.debug(f"Narration saved: {output_file}")
 
             # Validate the generated audio file before adding it to the final list
-            if validate_audio(output_file):
+            if await run_cpu(validate_audio, output_file):
                 narration_paths.append(output_file)
             else:
                 logging.warning(f"Invalid audio file detected: {output_file}, skipping.")
 
         return narration_paths
 
+    except asyncio.CancelledError:
+        logging.info(f"Narration cancelled, removing {len(written_paths)} partial file(s).")
+        for path in written_paths:
+            os.remove(path)
+        raise
+
     except Exception as e:
         logging.error(f"Unexpected error in TTS generation: {e}")
         return []
+
+def generate_narration(text_files, output_folder=NARRATIONS_DIR, deadline=None, request_id=None):
+    """Blocking wrapper around `generate_narration_async` for scripts and benchmarks."""
+    return asyncio.run(generate_narration_async(text_files, output_folder, deadline, request_id))
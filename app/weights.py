@@ -0,0 +1,162 @@
+import os
+import json
+import struct
+import logging
+import torch
+from safetensors.torch import save_file
+
+# --------------------------------------------------------
+# LOGGING CONFIGURATION
+# --------------------------------------------------------
+
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - [%(levelname)s] - %(message)s",
+)
+
+# --------------------------------------------------------
+# MEMORY-MAPPED MODEL WEIGHTS
+# --------------------------------------------------------
+# Weights are exported once to a local safetensors file and then loaded as tensors
+# that point straight into a read-only (copy-on-write) memory map of that file:
+# - loading costs no copy, so an evicted model comes back in about the time it takes
+#   to build its modules;
+# - the pages belong to the OS page cache, so every process on the host that maps
+#   the same file shares one physical copy of the weights.
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+def export_weights(model, path):
+    """
+    Writes every parameter and buffer of `model` to a safetensors file.
+
+    Tensors shared between modules (tied weights) are stored once and the other names
+    are recorded as aliases in the file metadata. Non-persistent buffers are included,
+    so the file alone is enough to fill a model built on the meta device.
+
+    Parameters:
+        model (torch.nn.Module): The loaded model.
+        path (str): Destination file; written atomically.
+    """
+    tensors = {}
+    aliases = {}
+    seen = {}
+
+    named = list(model.named_parameters(remove_duplicate=False)) + list(model.named_buffers(remove_duplicate=False))
+    for name, tensor in named:
+        if tensor is None:
+            continue
+        if id(tensor) in seen:
+            aliases[name] = seen[id(tensor)]
+            continue
+        seen[id(tensor)] = name
+        tensors[name] = tensor.detach().contiguous()
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    save_file(tensors, temp_path, metadata={"aliases": json.dumps(aliases)})
+    os.replace(temp_path, path)  # Other processes never see a half-written file
+
+    logging.info(f"Exported {len(tensors)} tensors ({len(aliases)} aliases) to {path}")
+
+def load_weights_mmap(path):
+    """
+    Maps a safetensors file into memory and returns tensors that view the mapping.
+
+    Returns:
+        tuple: (tensors, aliases) where tensors maps names to mmap-backed tensors and
+        aliases maps tied tensor names to the name they share storage with.
+    """
+    with open(path, "rb") as file:
+        header_size = struct.unpack("<Q", file.read(8))[0]
+        header = json.loads(file.read(header_size))
+    file_size = os.path.getsize(path)
+
+    metadata = header.pop("__metadata__", None) or {}
+    aliases = json.loads(metadata.get("aliases", "{}"))
+
+    # shared=False maps the file privately: pages are shared until written, and writes never reach the file
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=file_size)
+    data = torch.empty(0, dtype=torch.uint8).set_(storage, 0, (file_size,))
+    data_start = 8 + header_size
+
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        raw = data[data_start + begin:data_start + end]
+        try:
+            tensors[name] = raw.view(dtype).reshape(info["shape"])
+        except RuntimeError:
+            # Offset not aligned to the element size: this tensor has to be copied
+            tensors[name] = raw.clone().view(dtype).reshape(info["shape"])
+
+    return tensors, aliases
+
+def assign_weights(model, tensors, aliases):
+    """
+    Points every parameter and buffer of `model` at the given tensors without copying.
+
+    Parameters:
+        model (torch.nn.Module): Usually a model built on the meta device.
+        tensors (dict): Name -> tensor, as returned by `load_weights_mmap`.
+        aliases (dict): Tied name -> name of the tensor it shares.
+
+    Raises:
+        ValueError: If a tensor's shape differs from the model's, or a parameter or
+        buffer of the model has no tensor in the file.
+    """
+    assigned = {}
+    for name in list(tensors) + list(aliases):
+        source = aliases.get(name, name)
+        module_name, _, attribute = name.rpartition(".")
+        module = model.get_submodule(module_name)
+
+        current = module._parameters.get(attribute, module._buffers.get(attribute))
+        if current is not None and current.shape != tensors[source].shape:
+            raise ValueError(f"Weights file does not fit the model: {name} has shape "
+                             f"{tuple(tensors[source].shape)}, expected {tuple(current.shape)}")
+
+        if attribute in module._parameters:
+            if source not in assigned:
+                assigned[source] = torch.nn.Parameter(tensors[source], requires_grad=False)
+            module._parameters[attribute] = assigned[source]
+        else:
+            module._buffers[attribute] = tensors[source]
+
+    missing = [name for name, tensor in list(model.named_parameters()) + list(model.named_buffers())
+               if tensor.is_meta]
+    if missing:
+        raise ValueError(f"Weights file has no tensors for {len(missing)} entries, e.g. {missing[:3]}")
+
+def resident_memory_bytes():
+    """
+    Returns the resident set size of this process in bytes.
+
+    Reads VmRSS from /proc/self/status on Linux and falls back to the peak RSS
+    reported by getrusage elsewhere (0 if neither is available).
+    """
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as file:
+            for line in file:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == "Darwin" else peak * 1024
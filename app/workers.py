@@ -0,0 +1,57 @@
+import asyncio
+import functools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from config import CPU_WORKERS
+from profiling import profile_call
+
+# --------------------------------------------------------
+# CPU-BOUND WORK EXECUTOR
+# --------------------------------------------------------
+
+# Shared pool for CPU-bound stages (MusicGen, validation, mixing). Its size, not the
+# number of open sessions, bounds how much CPU work runs at once; sessions waiting on
+# the LLM or TTS backends do not hold a thread.
+cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu-worker")
+
+# Set when the coroutine awaiting the current executor call is cancelled. A thread cannot
+# be interrupted, so long-running functions poll it (see `cancelled()`) and stop early.
+current_cancel_event = contextvars.ContextVar("current_cancel_event", default=None)
+
+def cancelled():
+    """Returns True if the caller awaiting the current `run_cpu` call has given up."""
+    event = current_cancel_event.get()
+    return event is not None and event.is_set()
+
+def call_with_cancel_event(cancel_event, func, *args, **kwargs):
+    """Runs `func` (profiled if sampled) with `cancel_event` as the current cancel event."""
+    current_cancel_event.set(cancel_event)
+    return profile_call(func, *args, **kwargs)
+
+async def run_cpu(func, *args, **kwargs):
+    """
+    Runs a blocking, CPU-bound function on the shared CPU executor and awaits its result.
+
+    The caller's context variables (e.g. the request profile) are visible inside `func`,
+    and the call is profiled when the current request is sampled for profiling. If the
+    awaiting task is cancelled, `cancelled()` becomes True inside `func` so it can stop.
+
+    Parameters:
+        func (callable): The function to run.
+        *args, **kwargs: Arguments passed to `func`.
+
+    Returns:
+        The return value of `func`.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    cancel_event = threading.Event()
+    call = functools.partial(context.run, call_with_cancel_event, cancel_event, func, *args, **kwargs)
+    try:
+        return await loop.run_in_executor(cpu_executor, call)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        metrics.increment("workers.cpu_calls_cancelled")
+        raise